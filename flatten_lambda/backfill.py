@@ -0,0 +1,129 @@
+# Re-flatten the whole raw-shopify/ prefix from a laptop or build box, e.g.
+# after the size or category lexicons change:
+#
+#   python backfill.py --prefix raw-shopify/2025-05 --processes 8
+#
+# Raw objects are downloaded concurrently into a local cache keyed by ETag, so
+# repeated backfills only fetch inputs that changed since the last run.
+import argparse
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from s3transfer.manager import TransferConfig, TransferManager
+
+import lambda_function as lf
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "simplyaboveaverage", lf.INPUT_PREFIX)
+DOWNLOAD_CONCURRENCY = 16
+
+
+def list_raw_objects(bucket, prefix):
+    paginator = lf.s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            key = obj["Key"]
+            if key.endswith("/") or key.endswith(lf.MANIFEST_SUFFIX):
+                continue
+            yield {"key": key, "etag": lf._normalize_etag(obj["ETag"]), "size": obj["Size"]}
+
+
+def cache_path(cache_dir, obj):
+    # Keep the compression extension so the reader can detect it
+    extension = next((ext for ext in lf.COMPRESSION_EXTENSIONS.values() if obj["key"].endswith(ext)), "")
+    return os.path.join(cache_dir, obj["etag"] + extension)
+
+
+def download_missing(bucket, objects, cache_dir, concurrency):
+    os.makedirs(cache_dir, exist_ok=True)
+    # Identical files share an ETag and therefore a single cache entry
+    missing = {
+        cache_path(cache_dir, obj): obj for obj in objects
+        if not os.path.exists(cache_path(cache_dir, obj))
+    }
+    print(f"📥 Downloading {len(missing)} uncached raw files ({len(objects)} listed)")
+    if not missing:
+        return
+
+    config = TransferConfig(max_request_concurrency=concurrency, max_submission_concurrency=concurrency)
+    with TransferManager(lf.s3, config) as manager:
+        futures = [
+            (path, obj, manager.download(bucket, obj["key"], path + ".part"))
+            for path, obj in missing.items()
+        ]
+        for path, obj, future in futures:
+            future.result()
+            if os.path.getsize(path + ".part") != obj["size"]:
+                os.remove(path + ".part")
+                raise RuntimeError(f"{obj['key']} changed while downloading; re-run the backfill")
+            os.replace(path + ".part", path)
+
+
+def read_chunks(path):
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(lf.READ_CHUNK_SIZE), b""):
+            yield chunk
+
+
+def flatten_cached(bucket, obj, path):
+    output_key = lf.output_key_for(obj["key"])
+    lines = lf.iter_lines(lf.decompress_chunks(read_chunks(path), lf.detect_compression(obj["key"])))
+    stats = {"products": 0}
+    try:
+        with lf.OutputWriter(bucket, output_key) as writer:
+            for flat_row in lf.flatten_lines(lines, stats):
+                writer.write(flat_row)
+    except Exception as e:
+        return {"key": obj["key"], "status": "error", "error": str(e)}
+    return {"key": obj["key"], "output_key": output_key, "status": "ok", "rows": writer.row_count, **stats}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Re-flatten raw-shopify/ into cleaned-shopify/")
+    parser.add_argument("--bucket", default=lf.BUCKET_NAME)
+    parser.add_argument("--prefix", default=lf.INPUT_PREFIX + "/")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR)
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--download-concurrency", type=int, default=DOWNLOAD_CONCURRENCY)
+    parser.add_argument("--dry-run", action="store_true", help="list the files that would be flattened")
+    args = parser.parse_args(argv)
+
+    objects = list(list_raw_objects(args.bucket, args.prefix))
+    print(f"🔎 Found {len(objects)} raw files under s3://{args.bucket}/{args.prefix}")
+    if args.dry_run:
+        for obj in objects:
+            print(f"  {obj['key']} ({obj['size']} bytes) -> {lf.output_key_for(obj['key'])}")
+        return 0
+
+    download_missing(args.bucket, objects, args.cache_dir, args.download_concurrency)
+    rules = lf.refresh_rules(force=True)
+    print(f"📐 Flattening with rules {rules.digest[:12]}")
+
+    # spawn: the parent still has s3transfer threads around from the downloads
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(
+        max_workers=max(1, args.processes), mp_context=ctx, initializer=lf.install_rules, initargs=(rules,),
+    ) as pool:
+        futures = [
+            pool.submit(flatten_cached, args.bucket, obj, cache_path(args.cache_dir, obj))
+            for obj in objects
+        ]
+        results = []
+        for future in futures:
+            result = future.result()
+            results.append(result)
+            if result["status"] == "ok":
+                print(f"✅ {result['key']}: {result['rows']} rows -> {result['output_key']}")
+            else:
+                print(f"❌ {result['key']}: {result['error']}")
+
+    failed = [r for r in results if r["status"] != "ok"]
+    print(f"🏁 Flattened {len(results) - len(failed)}/{len(results)} files, "
+          f"{sum(r.get('rows', 0) for r in results)} rows")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
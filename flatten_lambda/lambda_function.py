@@ -1,10 +1,36 @@
 import boto3
 import pandas as pd
 import re
+import bisect
+import functools
 from bs4 import BeautifulSoup
+from bs4.builder._htmlparser import HTMLParserTreeBuilder
+from bs4.dammit import EntitySubstitution
 import json
+import gzip
+import hashlib
 import io
+import multiprocessing
+import os
+import pickle
+import queue
+import threading
 import time
+import uuid
+import zlib
+from collections import Counter, OrderedDict, deque, namedtuple
+from datetime import datetime, timezone
+from html.parser import HTMLParser
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote_plus
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from s3transfer.manager import TransferConfig, TransferManager
+
+try:
+    import zstandard
+except ImportError:  # only needed for .zst objects / OUTPUT_COMPRESSION=zstd
+    zstandard = None
 
 
 s3 = boto3.client("s3")
@@ -14,13 +40,370 @@ BUCKET_NAME = "simplyaboveaverage-scrapy"
 INPUT_PREFIX = "raw-shopify"
 OUTPUT_PREFIX = "cleaned-shopify"
 OUTPUT_COLUMNS = [
-   "product_id", "variant_id", "product_title", "variant_title", "description", "image_url", "category", "vendor",
-   "price", "available", "size", "color", "length", "inseam", "product_url",  "primary_category", "subcategory"
+   "product_id", "variant_id", "product_title", "variant_title", "description", "image_url", "category", "tags", "vendor",
+   "price", "available", "size", "color", "length", "inseam", "product_url",  "primary_category", "subcategory",
+   "waist_in", "inseam_in", "alpha_size_rank", "shoe_size", "width", "fit_class"
 ]
 
+# Raw dumps are read in chunks and split into lines as they arrive, so only
+# one product is held in memory at a time.
+READ_CHUNK_SIZE = 64 * 1024
+# Records in a batched S3/SQS event are processed concurrently by this many threads.
+MAX_WORKERS = int(os.environ.get("MAX_WORKERS", "4"))
+# "json" writes a compact JSON array, "ndjson" writes one row per line.
+OUTPUT_FORMAT = os.environ.get("OUTPUT_FORMAT", "json")
+# Output is streamed to S3 as a multipart upload while rows are still being
+# mapped. Memory is bounded by the queued chunks plus the parts in flight.
+UPLOAD_PART_SIZE = 8 * 1024 * 1024
+UPLOAD_QUEUE_CHUNK_SIZE = 1024 * 1024
+UPLOAD_QUEUE_DEPTH = 8
+UPLOAD_CONCURRENCY = 4
+# "none", "gzip" or "zstd". Compressed outputs get a .gz / .zst extension and a
+# matching Content-Encoding; inputs are detected the same way.
+OUTPUT_COMPRESSION = os.environ.get("OUTPUT_COMPRESSION", "none")
+COMPRESSION_EXTENSIONS = {"gzip": ".gz", "zstd": ".zst"}
+# "object": flatten each raw file when its own S3 event arrives, checked against
+# the size/ETag in the event. "manifest": wait for the producer's completion
+# manifest and flatten the files it lists; per-file events are skipped.
+READINESS_MODE = os.environ.get("READINESS_MODE", "object")
+# Completion manifest written by the producer after the last data file:
+# {"files": [{"key": "raw-shopify/...", "size": 123, "etag": "...", "rows": 45}, ...]}
+MANIFEST_SUFFIX = "_manifest.json"
+# Uncompressed raw files at least this big are split into newline-aligned byte
+# ranges and flattened by parallel invocations of this same function. Shard
+# outputs are staged under SHARD_PREFIX (outside cleaned-shopify/, so the upload
+# stage never sees them) and merged in order into the usual output key.
+SHARD_THRESHOLD_BYTES = int(os.environ.get("SHARD_THRESHOLD_BYTES", str(256 * 1024 * 1024)))
+SHARD_SIZE_BYTES = int(os.environ.get("SHARD_SIZE_BYTES", str(64 * 1024 * 1024)))
+SHARD_CONCURRENCY = int(os.environ.get("SHARD_CONCURRENCY", "8"))
+SHARD_FUNCTION_NAME = os.environ.get("SHARD_FUNCTION_NAME", os.environ.get("AWS_LAMBDA_FUNCTION_NAME"))
+SHARD_PREFIX = "flatten-shards"
+SHARD_PROBE_BYTES = 64 * 1024
+# Files at least this big are flattened on PARALLEL_PROCESSES cores. Workers
+# talk over multiprocessing Pipes because Lambda has no /dev/shm for the
+# semaphores behind Pool and Queue. Batches of about PARALLEL_BATCH_BYTES of raw
+# lines go out round-robin and come back in order.
+PARALLEL_PROCESSES = int(os.environ.get("PARALLEL_PROCESSES", str(os.cpu_count() or 1)))
+PARALLEL_MIN_BYTES = int(os.environ.get("PARALLEL_MIN_BYTES", str(8 * 1024 * 1024)))
+PARALLEL_BATCH_BYTES = 1024 * 1024
+# clean_html results keyed by a hash of the raw body_html. Kept in memory for
+# warm containers, occasionally snapshotted to /tmp (read back if the module is
+# re-initialised in the same execution environment), and optionally to S3
+# (HTML_CACHE_S3_KEY) so cold starts begin warm.
+HTML_CACHE_MAX_ENTRIES = int(os.environ.get("HTML_CACHE_MAX_ENTRIES", "50000"))
+HTML_CACHE_PATH = "/tmp/clean_html_cache.json.gz"
+HTML_CACHE_S3_KEY = os.environ.get("HTML_CACHE_S3_KEY")
+# Only rewrite the /tmp snapshot / re-upload the S3 snapshot once this many
+# new entries have accumulated. /tmp only survives within one execution
+# environment, which already holds the entries in memory, so it is cheap
+# insurance rather than something to pay for on every invocation.
+HTML_CACHE_TMP_MIN_NEW = 1000
+HTML_CACHE_S3_MIN_NEW = 1000
+# Snapshots are rewritten whole; favour speed over size
+HTML_CACHE_COMPRESSLEVEL = 1
+# smart_map_variant results keyed by the normalised option values and titles.
+# Module-level, so warm invocations start with the previous run's mappings.
+VARIANT_CACHE_MAX_ENTRIES = int(os.environ.get("VARIANT_CACHE_MAX_ENTRIES", "100000"))
+# Per-vendor option layouts (option position -> field, size formats seen)
+# learned from earlier runs and kept in S3. An "active" profile routes a
+# vendor's unnamed options without the lexicon scan; if more than
+# VENDOR_PROFILE_MAX_MISS_RATE of its variants stop fitting, the vendor is
+# flagged and mapped heuristically until it has been re-learned. An empty
+# VENDOR_PROFILES_S3_KEY keeps profiles in memory only.
+VENDOR_PROFILES_S3_KEY = os.environ.get("VENDOR_PROFILES_S3_KEY", "flatten-state/vendor_profiles.json")
+VENDOR_PROFILE_VERSION = 1
+VENDOR_PROFILE_MIN_VARIANTS = int(os.environ.get("VENDOR_PROFILE_MIN_VARIANTS", "200"))
+VENDOR_PROFILE_MIN_SHARE = 0.95
+VENDOR_PROFILE_MIN_CHECKED = 50
+VENDOR_PROFILE_MAX_MISS_RATE = 0.05
+# Option values no lexicon recognises ("unmapped"), that only the option name
+# placed ("name_only"), or that several lexicons claim ("ambiguous") are
+# tallied per run and written to OPTION_TELEMETRY_PREFIX/<date>/<run>.json;
+# unmapped_report.py merges the reports. An empty prefix disables the report.
+OPTION_TELEMETRY_PREFIX = os.environ.get("OPTION_TELEMETRY_PREFIX", "flatten-telemetry/options")
+OPTION_TELEMETRY_VERSION = 1
+OPTION_TELEMETRY_MAX_VALUES = 1000
+OPTION_TELEMETRY_MAX_VENDORS = 5
+# Category keywords and the length/colour lexicons are versioned JSON rule
+# files. The copies in rules/ ship with the package; RULES_S3_PREFIX/<name>.json
+# in the bucket overrides them and is re-fetched (If-None-Match on its ETag)
+# at most every RULES_CHECK_INTERVAL seconds. Inside Lambda, compiled rules
+# are pickled to RULES_CACHE_PATH, so a container that starts with the same
+# files, or sees them again, skips compiling them; elsewhere (backfill.py and
+# reclassify.py on a shared machine) they are always compiled. An empty
+# prefix uses the packaged rules only.
+RULES_S3_PREFIX = os.environ.get("RULES_S3_PREFIX", "flatten-rules")
+RULES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rules")
+RULE_FILES = ("categories", "size_lexicon")
+RULES_VERSION = 1
+RULES_CACHE_PATH = "/tmp/flatten_rules.pickle" if os.environ.get("AWS_LAMBDA_FUNCTION_NAME") else None
+# Compiled rules depend on this module's code (tokenize, CategoryIndex, ...)
+# as well as on the rule files
+with open(os.path.abspath(__file__), "rb") as _module_source:
+    RULES_CODE_FINGERPRINT = hashlib.sha256(_module_source.read()).hexdigest()
+RULES_CHECK_INTERVAL = int(os.environ.get("RULES_CHECK_INTERVAL", "60"))
+
+
+class LRUCache:
+    # Bounded least-recently-used map with hit/miss/eviction counters. Safe to
+    # share between the record threads.
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.hits = self.misses = self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return self._data[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def items(self):
+        with self._lock:
+            return list(self._data.items())
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def add_counts(self, hits=0, misses=0, evictions=0):
+        # Fold in counters from a copy of this cache held by another process
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+            self.evictions += evictions
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+        }
+
+
+_html_cache = LRUCache(HTML_CACHE_MAX_ENTRIES)
+# "unsaved" / "unsaved_s3": entries added since the last /tmp and S3 snapshots;
+# "added": in flatten workers, entries not yet sent back to the parent
+_html_cache_state = {"loaded": False, "unsaved": 0, "unsaved_s3": 0, "added": None}
+_html_cache_lock = threading.Lock()
+
+
+def _load_html_snapshot(data):
+    snapshot = json.loads(gzip.decompress(data))
+    for digest, text in snapshot.get("entries", []):
+        _html_cache.put(digest, text)
+
+
+def load_html_cache():
+    with _html_cache_lock:
+        if _html_cache_state["loaded"]:
+            return
+        _html_cache_state["loaded"] = True
+        try:
+            if os.path.exists(HTML_CACHE_PATH):
+                with open(HTML_CACHE_PATH, "rb") as f:
+                    _load_html_snapshot(f.read())
+            elif HTML_CACHE_S3_KEY:
+                obj = s3.get_object(Bucket=BUCKET_NAME, Key=HTML_CACHE_S3_KEY)
+                _load_html_snapshot(obj["Body"].read())
+        except Exception as e:
+            # A missing or corrupt snapshot only costs us the warm start
+            print(f"⚠️ Could not load clean_html cache: {e}")
+        print(f"🗄️ Loaded {len(_html_cache)} cached descriptions")
+
+
+def save_html_cache():
+    with _html_cache_lock:
+        save_tmp = _html_cache_state["unsaved"] >= HTML_CACHE_TMP_MIN_NEW
+        save_s3 = bool(HTML_CACHE_S3_KEY) and _html_cache_state["unsaved_s3"] >= HTML_CACHE_S3_MIN_NEW
+        if not (save_tmp or save_s3):
+            return
+        data = gzip.compress(
+            json.dumps({"version": 1, "entries": _html_cache.items()}).encode("utf-8"),
+            compresslevel=HTML_CACHE_COMPRESSLEVEL,
+        )
+        try:
+            if save_tmp:
+                tmp_path = HTML_CACHE_PATH + ".part"
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, HTML_CACHE_PATH)
+                _html_cache_state["unsaved"] = 0
+            if save_s3:
+                s3.put_object(Bucket=BUCKET_NAME, Key=HTML_CACHE_S3_KEY, Body=data, ContentType="application/json", ContentEncoding="gzip")
+                _html_cache_state["unsaved_s3"] = 0
+        except Exception as e:
+            print(f"⚠️ Could not save clean_html cache: {e}")
+
+
+def drain_html_cache_entries():
+    added = _html_cache_state["added"] or []
+    _html_cache_state["added"] = []
+    return added
+
+
+def merge_html_cache_entries(entries):
+    # Descriptions cleaned in a flatten worker, so the parent snapshots them
+    if not _html_cache_state["loaded"]:
+        load_html_cache()
+    for digest, cleaned in entries:
+        _html_cache.put(digest, cleaned)
+    _html_cache_state["unsaved"] += len(entries)
+    _html_cache_state["unsaved_s3"] += len(entries)
+
 
 def clean_html(text):
-   return BeautifulSoup(str(text), "html.parser").get_text(separator=" ").strip()
+   text = str(text)
+   if not _html_cache_state["loaded"]:
+       load_html_cache()
+   digest = hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+   cleaned = _html_cache.get(digest)
+   if cleaned is None:
+       cleaned = html_to_text(text)
+       _html_cache.put(digest, cleaned)
+       _html_cache_state["unsaved"] += 1
+       _html_cache_state["unsaved_s3"] += 1
+       if _html_cache_state["added"] is not None:
+           _html_cache_state["added"].append((digest, cleaned))
+   return cleaned
+
+
+class _ComplexMarkup(Exception):
+    pass
+
+
+class _TextExtractor(HTMLParser):
+    # Streams the text out of simple markup with the same result as
+    # BeautifulSoup(text, "html.parser").get_text(separator=" "). bs4 runs the
+    # same tokenizer, so this only has to mirror how it groups text into
+    # strings: one string per run of data between tag/comment events, ASCII
+    # whitespace-only runs collapsed to "\n" or " ", and entities decoded
+    # bs4's way. Anything whose text bs4 treats specially (pre/textarea
+    # whitespace, script/style/template/ruby strings, CDATA, doctypes,
+    # processing instructions) raises _ComplexMarkup instead.
+    EMPTY_ELEMENTS = frozenset(HTMLParserTreeBuilder.DEFAULT_EMPTY_ELEMENT_TAGS)
+    COMPLEX_TAGS = frozenset(
+        HTMLParserTreeBuilder.DEFAULT_PRESERVE_WHITESPACE_TAGS
+        | set(HTMLParserTreeBuilder.DEFAULT_STRING_CONTAINERS)
+        | set(HTMLParser.CDATA_CONTENT_ELEMENTS)
+    )
+    ASCII_SPACES = "\x20\x0a\x09\x0c\x0d"
+
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self._strings = []
+        self._data = []
+        self._closed_empty = []
+
+    def text(self, markup):
+        self.feed(markup)
+        self.close()
+        self._end_data()
+        return " ".join(self._strings).strip()
+
+    def _end_data(self):
+        if self._data:
+            data = "".join(self._data)
+            self._data = []
+            if not data.strip(self.ASCII_SPACES):
+                data = "\n" if "\n" in data else " "
+            self._strings.append(data)
+
+    def handle_starttag(self, tag, attrs, empty_element=True):
+        if tag in self.COMPLEX_TAGS:
+            raise _ComplexMarkup(tag)
+        self._end_data()
+        if empty_element and tag in self.EMPTY_ELEMENTS:
+            # bs4 closes <br> at once and ignores a later stray </br>
+            self._closed_empty.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs, empty_element=False)
+        self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag in self.COMPLEX_TAGS:
+            raise _ComplexMarkup(tag)
+        if tag in self._closed_empty:
+            self._closed_empty.remove(tag)
+        else:
+            self._end_data()
+
+    def handle_data(self, data):
+        self._data.append(data)
+
+    def handle_entityref(self, name):
+        character = EntitySubstitution.HTML_ENTITY_TO_CHARACTER.get(name)
+        self._data.append(character if character is not None else f"&{name}")
+
+    def handle_charref(self, name):
+        # bs4 reads &#128;-&#255; as windows-1252 where it can
+        number = int(name[1:], 16) if name[:1] in ("x", "X") else int(name)
+        data = None
+        if number < 256:
+            try:
+                data = bytearray([number]).decode("windows-1252")
+            except UnicodeDecodeError:
+                pass
+        if not data:
+            try:
+                data = chr(number)
+            except (ValueError, OverflowError):
+                pass
+        self._data.append(data or "\N{REPLACEMENT CHARACTER}")
+
+    def handle_comment(self, data):
+        # A comment ends the current string and adds none of its own
+        self._end_data()
+
+    def handle_decl(self, data):
+        raise _ComplexMarkup("declaration")
+
+    def unknown_decl(self, data):
+        raise _ComplexMarkup("declaration")
+
+    def handle_pi(self, data):
+        raise _ComplexMarkup("processing instruction")
+
+
+# Markup that would make _TextExtractor give up; checked up front so it isn't parsed twice
+_COMPLEX_MARKUP = re.compile(
+    r"<(?:%s)[\s/>]|<!(?!--)|<\?" % "|".join(sorted(_TextExtractor.COMPLEX_TAGS)), re.IGNORECASE
+)
+
+
+def html_to_text(text):
+    # Tiered: plain text is returned as is, simple markup goes through the
+    # streaming _TextExtractor, and only the rest builds a BeautifulSoup tree.
+    # All three give the same result.
+    if "<" not in text and "&" not in text:
+        return text.strip()
+    if not _COMPLEX_MARKUP.search(text):
+        try:
+            return _TextExtractor().text(text)
+        except _ComplexMarkup:
+            pass
+    return BeautifulSoup(text, "html.parser").get_text(separator=" ").strip()
 
 
 def extract_first_image(images):
@@ -30,510 +413,1694 @@ def extract_first_image(images):
 
 
 def extract_color_from_text(*fields):
-   color_terms = ["black", "white", "red", "blue", "green", "navy", "beige", "brown", "tan", "gray", "grey", "purple", "orange", "pink", "cream", "ivory", "burgundy", "yellow", "olive"]
+   # Colour family of the first field that names one (see COLOR_SYNONYMS)
    for field in fields:
        if not field:
            continue
-       field_str = str(field).lower()
-       for color in color_terms:
-           if color in field_str:
-               return color.title()
+       family, _ = match_color(field)
+       if family:
+           return family
    return None
 
+
+# Category keywords (primary -> subcategory -> keywords) come from the
+# categories rule file. They are matched as whole words after tokenizing and
+# plural-stemming both sides, so "jeans" and "jean" are the same key and
+# "short" no longer matches inside "shorts".
+_TOKEN = re.compile(r"[a-z0-9]+")
+
+
+@functools.lru_cache(maxsize=65536)
+def _stem(token):
+    # Light plural stemming, applied to keywords and product text alike
+    if len(token) > 4 and token.endswith(("sses", "shes", "ches", "xes")):
+        return token[:-2]
+    if len(token) > 3 and token.endswith("s") and not token.endswith(("ss", "us", "is")):
+        return token[:-1]
+    return token
+
+
+def tokenize(text):
+    # "Women's Wide-Calf Boots" -> ["women", "wide", "calf", "boot"]
+    text = str(text or "").lower().replace("'", "").replace("\u2019", "")
+    return list(map(_stem, _TOKEN.findall(text)))
+
+
+class CategoryIndex:
+    # Hash index of the stemmed 1-3 word keywords, keyed by their last word.
+    # Classifying is one dict lookup per word of the product text (plus a
+    # prefix check on the rare hit), however many keywords there are.
+    # Built once per container; treat as read-only.
+    __slots__ = ("index",)
+
+    def __init__(self, categories):
+        entries = {}
+        rank = 0
+        for primary, sub_map in categories.items():
+            for sub, keywords in sub_map.items():
+                for keyword in keywords:
+                    # The first declaration of a keyword wins
+                    entries.setdefault(tuple(tokenize(keyword)), (rank, (primary, sub)))
+                    rank += 1
+        index = {}
+        for words, (rank, category) in entries.items():
+            index.setdefault(words[-1], []).append((len(words), words[:-1], rank, category))
+        # Longer n-grams first, then declaration order
+        self.index = {word: tuple(sorted(hits, key=lambda hit: (-hit[0], hit[2]))) for word, hits in index.items()}
+
+    def best(self, tokens):
+        # The rightmost match wins (the head noun of "Denim Short" is "short"),
+        # then the longer n-gram, then the earlier declaration
+        index = self.index
+        for end in range(len(tokens) - 1, -1, -1):
+            hits = index.get(tokens[end])
+            if not hits:
+                continue
+            for n, prefix, _, category in hits:
+                if n == 1 or (end + 1 >= n and tuple(tokens[end + 1 - n:end]) == prefix):
+                    return category
+        return None
+
+    def classify(self, title, product_type, tags=None):
+        # product_type names the product most directly, then the title; tags
+        # are only a fallback. Each field is tokenized once.
+        if isinstance(tags, str):
+            tags = tags.split(",")
+        for tokens in (tokenize(product_type), tokenize(title)):
+            category = self.best(tokens)
+            if category:
+                return category
+        for tag in tags or []:
+            category = self.best(tokenize(tag))
+            if category:
+                return category
+        return None
+
+
 def map_categories(title, product_type, tags=None):
-    title = (title or "").lower()
-    product_type = (product_type or "").lower()
-    tags = [t.lower() for t in (tags or [])]
-
-    combined_text = f"{title} {product_type} {' '.join(tags)}"
-
-    categories = {
-        "Shoes": {
-            "Heels": ["heel", "heels", "stiletto", "kitten heel", "platform heel"],
-            "Flats": ["flat", "ballet flat", "loafers"],
-            "Sneakers": ["sneaker", "running shoe", "trainers"],
-            "Boots": ["boot", "boots", "ankle boot", "knee boot"],
-            "Sandals": ["sandal", "slides", "flip flop", "flip flops"],
-            "Wide-calf boot":["wide calf boot", "wide calf boots", "wide-calf boot", "wide-calf boots"],
-        },
-        "Bottoms": {
-            "Jeans": ["jean", "jeans", "denim", "straight jean", "flare", "bootcut", "wide leg jean", "skinny jean"],
-            "Pants": ["pant", "pants", "trouser", "slacks", "chino", "cargo pant", "jogger", "leggings"],
-            "Shorts": ["short", "shorts", "bermuda short", "biker short"],
-            "Skirts": ["skirt", "mini skirt", "midi skirt", "maxi skirt"],
-        },
-        "Tops": {
-            "Blouses": ["blouse", "peasant top", "ruffle top"],
-            "Shirts": ["shirt", "button-down", "button up", "oxford"],
-            "T-Shirts": ["t-shirt", "tee", "graphic tee", "graphic t-shirt"],
-            "Tanks": ["tank", "tank top", "camisole", "cami"],
-            "Sweaters": ["sweater", "pullover", "cardigan", "knit"],
-        },
-        "Dresses": {
-            "Maxi": ["maxi dress"],
-            "Mini": ["mini dress"],
-            "Midi": ["midi dress"],
-            "Bodycon": ["bodycon"],
-            "Wrap": ["wrap dress"],
-            "Slip": ["slip dress"],
-            "Shirt Dress": ["shirt dress"],
-        },
-        "Outerwear": {
-            "Jackets": ["jacket", "blazer", "bomber"],
-            "Coats": ["coat", "trench", "puffer", "parka"],
-        },
-        "Accessories": {
-            "Belts": ["belt"],
-            "Hats": ["hat", "beanie", "cap"],
-            "Bags": ["bag", "purse", "tote", "clutch"],
+    return CATEGORY_INDEX.classify(title, product_type, tags) or ("Other", None)
+
+
+# Size grammar. Each rule is tried in order against the whole (lowercased,
+# whitespace-collapsed) value; the first one that matches decides the system.
+# Waists, inseams and shoe sizes are open ranges rather than enumerated literals.
+_ALPHA = r"\d?x{1,5}[sl]|[sml]|\dx"
+# Spelled-out letter sizes, rewritten to their _ALPHA label before parsing
+ALPHA_SIZE_WORDS = {
+    "xxx-small": "xxxs", "xx-small": "xxs", "x-small": "xs", "x small": "xs", "extra small": "xs",
+    "small": "s", "medium": "m", "large": "l",
+    "x-large": "xl", "x large": "xl", "extra large": "xl", "xx-large": "xxl", "xxx-large": "xxxl",
+    "2x-large": "2xl", "3x-large": "3xl", "4x-large": "4xl", "5x-large": "5xl",
+}
+_ALPHA_WORDS = "|".join(re.escape(word) for word in sorted(ALPHA_SIZE_WORDS, key=len, reverse=True))
+_ALPHA_WORD = re.compile(rf"(?<![a-z0-9-])(?:{_ALPHA_WORDS})(?![a-z0-9-])")
+_WAIST_FIT = r"big and tall|big tall|extra tall|regular|short|long|tall|reg|xlt|big|bt|xt|r|l|s|t|b"
+SIZE_RULES = [
+    ("neck", r"(?P<neck>1\d(?:\.5)?) ?x ?(?P<sleeve>\d{2})"),
+    ("waist", r"(?P<waist>[2-9]\d)w? ?x ?(?P<inseam>\d{2})l?(?: length)?"),
+    ("waist", rf"(?P<waist>[2-9]\d)(?:w|w?[ -]?(?P<fit>{_WAIST_FIT}))"),
+    ("alpha", rf"(?P<label>{_ALPHA})(?:/(?P<label2>{_ALPHA}))?"),
+    ("alpha", r"(?P<label>\d?x{0,5}l|m|\dx|s(?=lt))?(?P<fit>l?t|xt|mt)"),
+    ("alpha", r"(?P<label>\dx)(?P<fit>b)"),
+    ("us_shoe", r"(?P<size>\d{1,2}(?:\.5| 1/2)?) ?(?P<width>wide|w|[2-6]e)"),
+    ("eu", r"eu ?(?P<size>\d{2}(?:\.5)?)"),
+    ("uk", r"uk ?(?P<size>\d{1,2})"),
+    ("numeric", r"(?P<size>0{1,3}|\d{1,2}(?:\.5| 1/2)?)"),
+]
 
-        }
-    }
+FIT_ALIASES = {
+    "r": "regular", "reg": "regular", "regular": "regular",
+    "l": "long", "long": "long",
+    "s": "short", "short": "short",
+    "t": "tall", "lt": "tall", "mt": "tall", "tall": "tall",
+    "xt": "extra tall", "xlt": "extra tall", "extra tall": "extra tall",
+    "b": "big", "big": "big",
+    "bt": "big and tall", "big tall": "big and tall", "big and tall": "big and tall",
+}
 
-    for primary_cat, sub_map in categories.items():
-        for sub_cat, keywords in sub_map.items():
-            for kw in keywords:
-                if kw in combined_text:
-                    return primary_cat, sub_cat
-    return "Other", None
+# Suit/blazer sizes (40R, 42L) share the waist grammar but aren't waists
+NON_WAIST_CATEGORIES = ("Tops", "Outerwear", "Shoes")
+# Ordinal for letter sizes so they can be range-filtered; "s/m" sits halfway
+ALPHA_SIZE_RANKS = {
+    "xxxs": 1, "xxs": 2, "xs": 3, "s": 4, "m": 5, "l": 6,
+    "xl": 7, "xxl": 8, "xxxl": 9, "xxxxl": 10, "xxxxxl": 11,
+}
+# Length terms (LENGTH_TERMS) that describe a fit rather than a width
+LENGTH_FIT_CLASSES = {
+    "tall": "tall", "extra tall": "extra tall", "short": "short", "petite": "petite",
+    "regular": "regular", "med": "regular", "medium": "regular", "long": "long", "xlong": "extra long",
+    "big": "big", "big and tall": "big and tall", "portly regular": "portly", "portly long": "portly",
+}
 
-def smart_map_variant(variant, product_title=""):
-   size = color = length = inseam = None
+SizeSpec = namedtuple("SizeSpec", ["system", "label", "waist", "inseam", "width", "fit"])
 
+_SIZE_RULES = [(system, re.compile(rf"(?:size )?(?:{pattern})")) for system, pattern in SIZE_RULES]
+# The same grammar, unanchored and without named groups, for scanning titles
+SIZE_SEARCH = re.compile(
+    r"(?<![a-z0-9-])(?:size )?(?:"
+    + "|".join([_ALPHA_WORDS] + [re.sub(r"\(\?P<\w+>", "(?:", pattern) for _, pattern in SIZE_RULES])
+    + r")(?![a-z0-9-])"
+)
 
-   option_keys = ["option1", "option2", "option3"]
-   option_values = [str(variant.get(k, "")).strip().lower() for k in option_keys]
 
-   # Add these for inseam scanning later
-   variant_title = str(variant.get("title", "")).strip().lower()
-   product_title = str(product_title).strip().lower()
+def _alpha_words(text):
+    return _ALPHA_WORD.sub(lambda match: ALPHA_SIZE_WORDS[match.group()], text)
 
-   color_keywords = [
-       "black", "white", "red", "blue", "green", "yellow", "pink", "purple",
-       "beige", "brown", "gray", "navy", "olive", "burgundy", "plaid", "stripe"
-       "sage", "sand", "stone", "slate","gold",
-   ]
-
-
-   alpha_sizes = {
-    # Standard alpha sizes
-    "xxxs", "xxs", "xs", "s", "m", "l", "xl", "xxl", "xxxl", "xxxxl", "xxxxxl",
-
-    # Extended alpha sizes
-    "2xs", "3xs", "4xs", "5xs", "1xl", "2xl", "3xl", "4xl", "5xl", "6xl", "7xl", "8xl",
-
-    # Big and tall sizes
-    "slt", "mt","lt", "xt", "xlt", 
-    "1xlt", "2xlt", "3xlt", "4xlt", "5xlt", "6xlt", "7xlt", "8xlt",
-    "mxt", "lxt", "xlxt", "1xlxt","2xlxt", "3xlxt", "4xlxt", "5xlxt", "6xlxt", "7xlxt", "8xlxt", 
-    "1xb", "2xb", "3xb", "4xb", "5xb", "6xb", "7xb", "8xb", "9xb",
-    "1xt",  "2xt",  "3xt",  "4xt",  "5xt",  "6xt",  "7xt",  "8xt",
-    "lmt", "xlmt", "2xmt", "3xmt", "4xmt", "5xmt",
-
-
-    # Plus sizes
-    "0x", "1x", "2x", "3x", "4x", "5x", "6x", "7x", "8x", "9x",
-
-    #Between Sizes
-    "XXS/XS","XS/S", "S/M", "M/L", "L/XL", "XL/1X",
-    "1x/2x", "2x/3x", "3x/4x", "4x/5x", "5x/6x",
-
-    # Numeric sizes (US women's)
-   "000", "00", "0", "2", "4", "6", "8", "10", "12", "14", "16", "18", "20", "22", "24", "26", "28", "30", "32", "34", "36",
-
-   # Shoe Sizes 
-    "2", "2.5", "3", "3.5", "4", "4.5", "5", "5.5", "6", "6.5", "7", "7.5", "8", "8.5", "9", "9.5", "10", "10.5",
-    "11", "11.5", "12", "12.5", "13", "13.5", "14", "14.5", "15", "15.5", "16", "16.5", "17", "17.5", "18",
-
-    "2", "2 1/2", "3", "3 1/2", "4", "4 1/2", "5", "5 1/2", "6", "6 1/2", "7", "7 1/2", "8", "8 1/2", "9", "9 1/2", "10", "10 1/2",
-    "11", "11 1/2", "12", "12 1/2", "13", "13 1/2", "14", "14 1/2", "15", "15 1/2", "16", "16 1/2", "17", "17 1/2", "18",
-
-    "2 W", "2.5 W", "3 W", "3.5 W", "4 W", "4.5 W", "5 W", "5.5 W", "6 W", "6.5 W", "7 W", "7.5 W", "8 W", "8.5 W", "9 W", "9.5 W", "10 W", "10.5 W",
-    "11 W", "11.5 W", "12 W", "12.5 W", "13 W", "13.5 W", "14 W", "14.5 W", "15 W", "15.5 W", "16 W", "16.5 W", "17 W", "17.5 W", "18 W",
-
-    "2 3E", "2.5 3E", "3 3E", "3.5 3E", "4 3E", "4.5 3E", "5 3E", "5.5 3E", "6 3E", "6.5 3E", "7 3E", "7.5 3E", "8 3E", "8.5 3E", "9 3E", "9.5 3E", "10 3E", "10.5 3E",
-    "11 3E", "11.5 3E", "12 3E", "12.5 3E", "13 3E", "13.5 3E", "14 3E", "14.5 3E", "15 3E", "15.5 3E", "16 3E", "16.5 3E", "17 3E", "17.5 3E", "18 3E",
-
-    "2 5E", "2.5 5E", "3 5E", "3.5 5E", "4 5E", "4.5 5E", "5 5E", "5.5 5E", "6 5E", "6.5 5E", "7 5E", "7.5 5E", "8 5E", "8.5 5E", "9 5E", "9.5 5E", "10 5E", "10.5 5E",
-    "11 5E", "11.5 5E", "12 5E", "12.5 5E", "13 5E", "13.5 5E", "14 5E", "14.5 5E", "15 5E", "15.5 5E", "16 5E", "16.5 5E", "17 5E", "17.5 5E", "18 5E",
-
-    "EU 36", "EU 36.5", "EU 37", "EU 37.5", "EU 38", "EU 38.5", "EU 39", "EU 39.5", "EU 40", "EU 40.5", "EU 41", "EU 41.5", "EU 42", "EU 42.5", "EU 43", "EU 43.5", "EU 44", "EU 44.5",
-    "EU 45", "EU 45.5", "EU 46", "EU 46.5", "EU 47", "EU 47.5", "EU 48", "EU 48.5", "EU 49", "EU 49.5", "EU 50",
-
-    "36", "36.5", "37", "37.5", "38", "38.5", "39", "39.5", "40", "40.5", "41", "41.5", "42", "42.5", "43", "43.5", "44", "44.5",
-    "45", "45.5", "46", "46.5", "47", "47.5", "48", "48.5", "49", "49.5", "50",
-
-
-    # Numeric waist sizes (men's pants)
-    "24", "25", "26", "27", "28", "29", "30", "31", "32", "33", "34", "35", "36", "38", "39", "40", "42", "44", "46", "48", "50", "52", "54", "56",
-
-    # Size Written Fortmat 
-    "Size 24", "Size 25", "Size 26", "Size 27", "Size 28", "Size 29", "Size 30", "Size 31", "Size 32", "Size 33", "Size 34", "Size 35", "Size 36", "Size 37", "Size 38", "Size 39", "Size 40", "Size 42", "Size 44", "Size 46", "Size 48", "Size 50", "Size 52", "Size 54", "Size 56",
-    "Size 24 ", "Size 25 ", "Size 26 ", "Size 27 ", "Size 28 ", "Size 29 ", "Size 30 ", "Size 31 ", "Size 32 ", "Size 33 ", "Size 34 ", "Size 35 ", "Size 36 ", "Size 37 ", "Size 38 ", "Size 39 ", "Size 40 ", "Size 42 ", "Size 44 ", "Size 46 ", "Size 48 ", "Size 50 ", "Size 52 ", "Size 54 ", "Size 56 ",
-    "Size 24 /", "Size 25 /", "Size 26 /", "Size 27 /", "Size 28 /", "Size 29 /", "Size 30 /", "Size 31 /", "Size 32 /", "Size 33 /", "Size 34 /", "Size 35 /", "Size 36 /", "Size 37 /", "Size 38 /", "Size 39 /", "Size 40 /", "Size 42 /", "Size 44 /", "Size 46 /", "Size 48 /", "Size 50 /", "Size 52 /", "Size 54 /", "Size 56 /",
-
-
-
-    # Waist x Inseam combinations
-    "28x30", "28x32", "28x34", "28x36", "28x38", "28x40", "28x42", "28x44", "28x46", "28x48", "28x50",
-    "30x30", "30x32", "30x34", "30x36", "30x38", "30x40", "30x42", "30x44", "30x46", "30x48", "30x50",
-    "32x30", "32x32", "32x34", "32x36", "32x38", "32x40", "32x42", "32x44", "32x46", "32x48", "32x50",
-    "34x30", "34x32", "34x34", "34x36", "34x38", "34x40", "34x42", "34x44", "34x46", "34x48", "34x50",
-    "36x30", "36x32", "36x34", "36x36", "36x38", "36x40", "36x42", "36x44", "36x46", "36x48", "36x50",
-    "38x30", "38x32", "38x34", "38x36", "38x38", "38x40", "38x42", "38x44", "38x46", "38x48", "38x50",
-    "40x30", "40x32", "40x34", "40x36", "40x38", "40x40", "40x42", "40x44", "40x46", "40x48", "40x50",
-    "42x30", "42x32", "42x34", "42x36", "42x38", "42x40", "42x42", "42x44", "42x46", "42x48", "42x50",
-    "44x30", "44x32", "44x34", "44x36", "44x38", "44x40", "44x42", "44x44", "44x46", "44x48", "44x50",
-    "46x30", "46x32", "46x34", "46x36", "46x38", "46x40", "46x42", "46x44", "46x46", "46x48", "46x50",
-    "48x30", "48x32", "48x34", "48x36", "48x38", "48x40", "48x42", "48x44", "48x46", "48x48", "48x50",
-    "50x30", "50x32", "50x34", "50x36", "50x38", "50x40", "50x42", "50x44", "50x46", "50x48", "50x50",
-    "52x30", "52x32", "52x34", "52x36", "52x38", "52x40", "52x42", "52x44", "52x46", "52x48", "52x50",
-    "54x30", "54x32", "54x34", "54x36", "54x38", "54x40", "54x42", "54x44", "54x46", "54x48", "54x50",
-    "56x30", "56x32", "56x34", "56x36", "56x38", "56x40", "56x42", "56x44", "56x46", "56x48", "56x50",
-    "58x30", "58x32", "58x34", "58x36", "58x38", "58x40", "58x42", "58x44", "58x46", "58x48", "58x50",
-    "60x30", "60x32", "60x34", "60x36", "60x38", "60x40", "60x42", "60x44", "60x46", "60x48", "60x50",
-    "62x30", "62x32", "62x34", "62x36", "62x38", "62x40", "62x42", "62x44", "62x46", "62x48", "62x50",
-    "64x30", "64x32", "64x34", "64x36", "64x38", "64x40", "64x42", "64x44", "64x46", "64x48", "64x50",
-    "66x30", "66x32", "66x34", "66x36", "66x38", "66x40", "66x42", "66x44", "66x46", "66x48", "66x50",
-    "68x30", "68x32", "68x34", "68x36", "68x38", "68x40", "68x42", "68x44", "68x46", "68x48", "68x50",
-    "70x30", "70x32", "70x34", "70x36", "70x38", "70x40", "70x42", "70x44", "70x46", "70x48", "70x50",
-    "72x30", "72x32", "72x34", "72x36", "72x38", "72x40", "72x42", "72x44", "72x46", "72x48", "72x50",
-    "74x30", "74x32", "74x34", "74x36", "74x38", "74x40", "74x42", "74x44", "74x46", "74x48", "74x50",
-    "76x30", "76x32", "76x34", "76x36", "76x38", "76x40", "76x42", "76x44", "76x46", "76x48", "76x50",
-    "78x30", "78x32", "78x34", "78x36", "78x38", "78x40", "78x42", "78x44", "78x46", "78x48", "78x50",
-    "80x30", "80x32", "80x34", "80x36", "80x38", "80x40", "80x42", "80x44", "80x46", "80x48", "80x50",
-
-
-    "28 x 30", "28 x 32", "28 x 34", "28 x 36", "28 x 38", "28 x 40", "28 x 42", "28 x 44", "28 x 46", "28 x 48", "28 x 50",
-    "30 x 30", "30 x 32", "30 x 34", "30 x 36", "30 x 38", "30 x 40", "30 x 42", "30 x 44", "30 x 46", "30 x 48", "30 x 50",
-    "32 x 30", "32 x 32", "32 x 34", "32 x 36", "32 x 38", "32 x 40", "32 x 42", "32 x 44", "32 x 46", "32 x 48", "32 x 50",
-    "34 x 30", "34 x 32", "34 x 34", "34 x 36", "34 x 38", "34 x 40", "34 x 42", "34 x 44", "34 x 46", "34 x 48", "34 x 50",
-    "36 x 30", "36 x 32", "36 x 34", "36 x 36", "36 x 38", "36 x 40", "36 x 42", "36 x 44", "36 x 46", "36 x 48", "36 x 50",
-    "38 x 30", "38 x 32", "38 x 34", "38 x 36", "38 x 38", "38 x 40", "38 x 42", "38 x 44", "38 x 46", "38 x 48", "38 x 50",
-    "40 x 30", "40 x 32", "40 x 34", "40 x 36", "40 x 38", "40 x 40", "40 x 42", "40 x 44", "40 x 46", "40 x 48", "40 x 50",
-    "42 x 30", "42 x 32", "42 x 34", "42 x 36", "42 x 38", "42 x 40", "42 x 42", "42 x 44", "42 x 46", "42 x 48", "42 x 50",
-    "44 x 30", "44 x 32", "44 x 34", "44 x 36", "44 x 38", "44 x 40", "44 x 42", "44 x 44", "44 x 46", "44 x 48", "44 x 50",
-    "46 x 30", "46 x 32", "46 x 34", "46 x 36", "46 x 38", "46 x 40", "46 x 42", "46 x 44", "46 x 46", "46 x 48", "46 x 50",
-    "48 x 30", "48 x 32", "48 x 34", "48 x 36", "48 x 38", "48 x 40", "48 x 42", "48 x 44", "48 x 46", "48 x 48", "48 x 50",
-    "50 x 30", "50 x 32", "50 x 34", "50 x 36", "50 x 38", "50 x 40", "50 x 42", "50 x 44", "50 x 46", "50 x 48", "50 x 50",
-    "52 x 30", "52 x 32", "52 x 34", "52 x 36", "52 x 38", "52 x 40", "52 x 42", "52 x 44", "52 x 46", "52 x 48", "52 x 50",
-    "54 x 30", "54 x 32", "54 x 34", "54 x 36", "54 x 38", "54 x 40", "54 x 42", "54 x 44", "54 x 46", "54 x 48", "54 x 50",
-    "56 x 30", "56 x 32", "56 x 34", "56 x 36", "56 x 38", "56 x 40", "56 x 42", "56 x 44", "56 x 46", "56 x 48", "56 x 50",
-    "58 x 30", "58 x 32", "58 x 34", "58 x 36", "58 x 38", "58 x 40", "58 x 42", "58 x 44", "58 x 46", "58 x 48", "58 x 50",
-    "60 x 30", "60 x 32", "60 x 34", "60 x 36", "60 x 38", "60 x 40", "60 x 42", "60 x 44", "60 x 46", "60 x 48", "60 x 50",
-    "62 x 30", "62 x 32", "62 x 34", "62 x 36", "62 x 38", "62 x 40", "62 x 42", "62 x 44", "62 x 46", "62 x 48", "62 x 50",
-    "64 x 30", "64 x 32", "64 x 34", "64 x 36", "64 x 38", "64 x 40", "64 x 42", "64 x 44", "64 x 46", "64 x 48", "64 x 50",
-    "66 x 30", "66 x 32", "66 x 34", "66 x 36", "66 x 38", "66 x 40", "66 x 42", "66 x 44", "66 x 46", "66 x 48", "66 x 50",
-    "68 x 30", "68 x 32", "68 x 34", "68 x 36", "68 x 38", "68 x 40", "68 x 42", "68 x 44", "68 x 46", "68 x 48", "68 x 50",
-    "70 x 30", "70 x 32", "70 x 34", "70 x 36", "70 x 38", "70 x 40", "70 x 42", "70 x 44", "70 x 46", "70 x 48", "70 x 50",
-    "72 x 30", "72 x 32", "72 x 34", "72 x 36", "72 x 38", "72 x 40", "72 x 42", "72 x 44", "72 x 46", "72 x 48", "72 x 50",
-    "74 x 30", "74 x 32", "74 x 34", "74 x 36", "74 x 38", "74 x 40", "74 x 42", "74 x 44", "74 x 46", "74 x 48", "74 x 50",
-    "76 x 30", "76 x 32", "76 x 34", "76 x 36", "76 x 38", "76 x 40", "76 x 42", "76 x 44", "76 x 46", "76 x 48", "76 x 50",
-    "78 x 30", "78 x 32", "78 x 34", "78 x 36", "78 x 38", "78 x 40", "78 x 42", "78 x 44", "78 x 46", "78 x 48", "78 x 50",
-    "80 x 30", "80 x 32", "80 x 34", "80 x 36", "80 x 38", "80 x 40", "80 x 42", "80 x 44", "80 x 46", "80 x 48", "80 x 50",
-
-
-    "28 x 30 length", "28 x 32 length", "28 x 34 length", "28 x 36 length", "28 x 38 length", "28 x 40 length", "28 x 42 length", "28 x 44 length", "28 x 46 length", "28 x 48 length", "28 x 50 length",
-    "30 x 30 length", "30 x 32 length", "30 x 34 length", "30 x 36 length", "30 x 38 length", "30 x 40 length", "30 x 42 length", "30 x 44 length", "30 x 46 length", "30 x 48 length", "30 x 50 length",
-    "32 x 30 length", "32 x 32 length", "32 x 34 length", "32 x 36 length", "32 x 38 length", "32 x 40 length", "32 x 42 length", "32 x 44 length", "32 x 46 length", "32 x 48 length", "32 x 50 length",
-    "34 x 30 length", "34 x 32 length", "34 x 34 length", "34 x 36 length", "34 x 38 length", "34 x 40 length", "34 x 42 length", "34 x 44 length", "34 x 46 length", "34 x 48 length", "34 x 50 length",
-    "36 x 30 length", "36 x 32 length", "36 x 34 length", "36 x 36 length", "36 x 38 length", "36 x 40 length", "36 x 42 length", "36 x 44 length", "36 x 46 length", "36 x 48 length", "36 x 50 length",
-    "38 x 30 length", "38 x 32 length", "38 x 34 length", "38 x 36 length", "38 x 38 length", "38 x 40 length", "38 x 42 length", "38 x 44 length", "38 x 46 length", "38 x 48 length", "38 x 50 length",
-    "40 x 30 length", "40 x 32 length", "40 x 34 length", "40 x 36 length", "40 x 38 length", "40 x 40 length", "40 x 42 length", "40 x 44 length", "40 x 46 length", "40 x 48 length", "40 x 50 length",
-    "42 x 30 length", "42 x 32 length", "42 x 34 length", "42 x 36 length", "42 x 38 length", "42 x 40 length", "42 x 42 length", "42 x 44 length", "42 x 46 length", "42 x 48 length", "42 x 50 length",
-    "44 x 30 length", "44 x 32 length", "44 x 34 length", "44 x 36 length", "44 x 38 length", "44 x 40 length", "44 x 42 length", "44 x 44 length", "44 x 46 length", "44 x 48 length", "44 x 50 length",
-    "46 x 30 length", "46 x 32 length", "46 x 34 length", "46 x 36 length", "46 x 38 length", "46 x 40 length", "46 x 42 length", "46 x 44 length", "46 x 46 length", "46 x 48 length", "46 x 50 length",
-    "48 x 30 length", "48 x 32 length", "48 x 34 length", "48 x 36 length", "48 x 38 length", "48 x 40 length", "48 x 42 length", "48 x 44 length", "48 x 46 length", "48 x 48 length", "48 x 50 length",
-    "50 x 30 length", "50 x 32 length", "50 x 34 length", "50 x 36 length", "50 x 38 length", "50 x 40 length", "50 x 42 length", "50 x 44 length", "50 x 46 length", "50 x 48 length", "50 x 50 length",
-    "52 x 30 length", "52 x 32 length", "52 x 34 length", "52 x 36 length", "52 x 38 length", "52 x 40 length", "52 x 42 length", "52 x 44 length", "52 x 46 length", "52 x 48 length", "52 x 50 length",
-    "54 x 30 length", "54 x 32 length", "54 x 34 length", "54 x 36 length", "54 x 38 length", "54 x 40 length", "54 x 42 length", "54 x 44 length", "54 x 46 length", "54 x 48 length", "54 x 50 length",
-    "56 x 30 length", "56 x 32 length", "56 x 34 length", "56 x 36 length", "56 x 38 length", "56 x 40 length", "56 x 42 length", "56 x 44 length", "56 x 46 length", "56 x 48 length", "56 x 50 length",
-    "58 x 30 length", "58 x 32 length", "58 x 34 length", "58 x 36 length", "58 x 38 length", "58 x 40 length", "58 x 42 length", "58 x 44 length", "58 x 46 length", "58 x 48 length", "58 x 50 length",
-    "60 x 30 length", "60 x 32 length", "60 x 34 length", "60 x 36 length", "60 x 38 length", "60 x 40 length", "60 x 42 length", "60 x 44 length", "60 x 46 length", "60 x 48 length", "60 x 50 length",
-    "62 x 30 length", "62 x 32 length", "62 x 34 length", "62 x 36 length", "62 x 38 length", "62 x 40 length", "62 x 42 length", "62 x 44 length", "62 x 46 length", "62 x 48 length", "62 x 50 length",
-    "64 x 30 length", "64 x 32 length", "64 x 34 length", "64 x 36 length", "64 x 38 length", "64 x 40 length", "64 x 42 length", "64 x 44 length", "64 x 46 length", "64 x 48 length", "64 x 50 length",
-    "66 x 30 length", "66 x 32 length", "66 x 34 length", "66 x 36 length", "66 x 38 length", "66 x 40 length", "66 x 42 length", "66 x 44 length", "66 x 46 length", "66 x 48 length", "66 x 50 length",
-    "68 x 30 length", "68 x 32 length", "68 x 34 length", "68 x 36 length", "68 x 38 length", "68 x 40 length", "68 x 42 length", "68 x 44 length", "68 x 46 length", "68 x 48 length", "68 x 50 length",
-    "70 x 30 length", "70 x 32 length", "70 x 34 length", "70 x 36 length", "70 x 38 length", "70 x 40 length", "70 x 42 length", "70 x 44 length", "70 x 46 length", "70 x 48 length", "70 x 50 length",
-    "72 x 30 length", "72 x 32 length", "72 x 34 length", "72 x 36 length", "72 x 38 length", "72 x 40 length", "72 x 42 length", "72 x 44 length", "72 x 46 length", "72 x 48 length", "72 x 50 length",
-    "74 x 30 length", "74 x 32 length", "74 x 34 length", "74 x 36 length", "74 x 38 length", "74 x 40 length", "74 x 42 length", "74 x 44 length", "74 x 46 length", "74 x 48 length", "74 x 50 length",
-    "76 x 30 length", "76 x 32 length", "76 x 34 length", "76 x 36 length", "76 x 38 length", "76 x 40 length", "76 x 42 length", "76 x 44 length", "76 x 46 length", "76 x 48 length", "76 x 50 length",
-    "78 x 30 length", "78 x 32 length", "78 x 34 length", "78 x 36 length", "78 x 38 length", "78 x 40 length", "78 x 42 length", "78 x 44 length", "78 x 46 length", "78 x 48 length", "78 x 50 length",
-    "80 x 30 length", "80 x 32 length", "80 x 34 length", "80 x 36 length", "80 x 38 length", "80 x 40 length", "80 x 42 length", "80 x 44 length", "80 x 46 length", "80 x 48 length", "80 x 50 length",
-
-    #Regular Sizes
-    "26R", "27R", "28R", "29R", "30R", "31R", "32R", "33R", "34R", "35R", "36R", "37R", "38R", "39R", "40R", "41R", "42R", "43R",
-    "44R", "45R", "46R", "47R", "48R", "49R", "50R", "51R", "52R", "53R", "54R", "55R", "56R", "57R", "58R", "59R", "60R", "61R",
-    "62R", "63R", "64R", "65R", "66R", "67R", "68R", "69R", "70R", "71R", "72R", "73R", "74R", "75R", "76R", "77R", "78R", "79R", "80R",
-
-    "26 Regular", "27 Regular", "28 Regular", "29 Regular", "30 Regular", "31 Regular", "32 Regular", "33 Regular", "34 Regular", "35 Regular", "36 Regular", "37 Regular", "38 Regular", "39 Regular", "40 Regular", "41 Regular", "42 Regular", "43 Regular",
-    "44 Regular", "45 Regular", "46 Regular", "47 Regular", "48 Regular", "49 Regular", "50 Regular", "51 Regular", "52 Regular", "53 Regular", "54 Regular", "55 Regular", "56 Regular", "57 Regular", "58 Regular", "59 Regular", "60 Regular", "61 Regular",
-    "62 Regular", "63 Regular", "64 Regular", "65 Regular", "66 Regular", "67 Regular", "68 Regular", "69 Regular", "70 Regular", "71 Regular", "72 Regular", "73 Regular", "74 Regular", "75 Regular", "76 Regular", "77 Regular", "78 Regular", "79 Regular", "80 Regular",
-
-    "26 Reg", "27 Reg", "28 Reg", "29 Reg", "30 Reg", "31 Reg", "32 Reg", "33 Reg", "34 Reg", "35 Reg", "36 Reg", "37 Reg", "38 Reg", "39 Reg", "40 Reg", "41 Reg", "42 Reg", "43 Reg",
-    "44 Reg", "45 Reg", "46 Reg", "47 Reg", "48 Reg", "49 Reg", "50 Reg", "51 Reg", "52 Reg", "53 Reg", "54 Reg", "55 Reg", "56 Reg", "57 Reg", "58 Reg", "59 Reg", "60 Reg", "61 Reg",
-    "62 Reg", "63 Reg", "64 Reg", "65 Reg", "66 Reg", "67 Reg", "68 Reg", "69 Reg", "70 Reg", "71 Reg", "72 Reg", "73 Reg", "74 Reg", "75 Reg", "76 Reg", "77 Reg", "78 Reg", "79 Reg", "80 Reg",
-
-    "26-Reg", "27-Reg", "28-Reg", "29-Reg", "30-Reg", "31-Reg", "32-Reg", "33-Reg", "34-Reg", "35-Reg", "36-Reg", "37-Reg", "38-Reg", "39-Reg", "40-Reg", "41-Reg", "42-Reg", "43-Reg",
-    "44-Reg", "45-Reg", "46-Reg", "47-Reg", "48-Reg", "49-Reg", "50-Reg", "51-Reg", "52-Reg", "53-Reg", "54-Reg", "55-Reg", "56-Reg", "57-Reg", "58-Reg", "59-Reg", "60-Reg", "61-Reg",
-    "62-Reg", "63-Reg", "64-Reg", "65-Reg", "66-Reg", "67-Reg", "68-Reg", "69-Reg", "70-Reg", "71-Reg", "72-Reg", "73-Reg", "74-Reg", "75-Reg", "76-Reg", "77-Reg", "78-Reg", "79-Reg", "80-Reg",
-
-    #Long Sizes
-    "26L", "27L", "28L", "29L", "30L", "31L", "32L", "33L", "34L", "35L", "36L", "37L", "38L", "39L", "40L", "41L", "42L", "43L",
-    "44L", "45L", "46L", "47L", "48L", "49L", "50L", "51L", "52L", "53L", "54L", "55L", "56L", "57L", "58L", "59L", "60L", "61L",
-    "62L", "63L", "64L", "65L", "66L", "67L", "68L", "69L", "70L", "71L", "72L", "73L", "74L", "75L", "76L", "77L", "78L", "79L", "80L",
-
-    "26 Long", "27 Long", "28 Long", "29 Long", "30 Long", "31 Long", "32 Long", "33 Long", "34 Long", "35 Long", "36 Long", "37 Long", "38 Long", "39 Long", "40 Long", "41 Long", "42 Long", "43 Long",
-    "44 Long", "45 Long", "46 Long", "47 Long", "48 Long", "49 Long", "50 Long", "51 Long", "52 Long", "53 Long", "54 Long", "55 Long", "56 Long", "57 Long", "58 Long", "59 Long", "60 Long", "61 Long",
-    "62 Long", "63 Long", "64 Long", "65 Long", "66 Long", "67 Long", "68 Long", "69 Long", "70 Long", "71 Long", "72 Long", "73 Long", "74 Long", "75 Long", "76 Long", "77 Long", "78 Long", "79 Long", "80 Long",
-
-    "26-Long", "27-Long", "28-Long", "29-Long", "30-Long", "31-Long", "32-Long", "33-Long", "34-Long", "35-Long", "36-Long", "37-Long", "38-Long", "39-Long", "40-Long", "41-Long", "42-Long", "43-Long",
-    "44-Long", "45-Long", "46-Long", "47-Long", "48-Long", "49-Long", "50-Long", "51-Long", "52-Long", "53-Long", "54-Long", "55-Long", "56-Long", "57-Long", "58-Long", "59-Long", "60-Long", "61-Long",
-    "62-Long", "63-Long", "64-Long", "65-Long", "66-Long", "67-Long", "68-Long", "69-Long", "70-Long", "71-Long", "72-Long", "73-Long", "74-Long", "75-Long", "76-Long", "77-Long", "78-Long", "79-Long", "80-Long",
-
-    #Tall Sizes
-    "26T", "27T", "28T", "29T", "30T", "31T", "32T", "33T", "34T", "35T", "36T", "37T", "38T", "39T", "40T", "41T", "42T", "43T",
-    "44T", "45T", "46T", "47T", "48T", "49T", "50T", "51T", "52T", "53T", "54T", "55T", "56T", "57T", "58T", "59T", "60T", "61T",
-    "62T", "63T", "64T", "65T", "66T", "67T", "68T", "69T", "70T", "71T", "72T", "73T", "74T", "75T", "76T", "77T", "78T", "79T", "80T",
-
-    "26 T", "27 T", "28 T", "29 T", "30 T", "31 T", "32 T", "33 T", "34 T", "35 T", "36 T", "37 T", "38 T", "39 T", "40 T", "41 T", "42 T", "43 T",
-    "44 T", "45 T", "46 T", "47 T", "48 T", "49 T", "50 T", "51 T", "52 T", "53 T", "54 T", "55 T", "56 T", "57 T", "58 T", "59 T", "60 T", "61 T",
-    "62 T", "63 T", "64 T", "65 T", "66 T", "67 T", "68 T", "69 T", "70 T", "71 T", "72 T", "73 T", "74 T", "75 T", "76 T", "77 T", "78 T", "79 T", "80 T",
-
-    "26 Tall", "27 Tall", "28 Tall", "29 Tall", "30 Tall", "31 Tall", "32 Tall", "33 Tall", "34 Tall", "35 Tall", "36 Tall", "37 Tall", "38 Tall", "39 Tall", "40 Tall", "41 Tall", "42 Tall", "43 Tall",
-    "44 Tall", "45 Tall", "46 Tall", "47 Tall", "48 Tall", "49 Tall", "50 Tall", "51 Tall", "52 Tall", "53 Tall", "54 Tall", "55 Tall", "56 Tall", "57 Tall", "58 Tall", "59 Tall", "60 Tall", "61 Tall",
-    "62 Tall", "63 Tall", "64 Tall", "65 Tall", "66 Tall", "67 Tall", "68 Tall", "69 Tall", "70 Tall", "71 Tall", "72 Tall", "73 Tall", "74 Tall", "75 Tall", "76 Tall", "77 Tall", "78 Tall", "79 Tall", "80 Tall",
-
-    "26-Tall", "27-Tall", "28-Tall", "29-Tall", "30-Tall", "31-Tall", "32-Tall", "33-Tall", "34-Tall", "35-Tall", "36-Tall", "37-Tall", "38-Tall", "39-Tall", "40-Tall", "41-Tall", "42-Tall", "43-Tall",
-    "44-Tall", "45-Tall", "46-Tall", "47-Tall", "48-Tall", "49-Tall", "50-Tall", "51-Tall", "52-Tall", "53-Tall", "54-Tall", "55-Tall", "56-Tall", "57-Tall", "58-Tall", "59-Tall", "60-Tall", "61-Tall",
-    "62-Tall", "63-Tall", "64-Tall", "65-Tall", "66-Tall", "67-Tall", "68-Tall", "69-Tall", "70-Tall", "71-Tall", "72-Tall", "73-Tall", "74-Tall", "75-Tall", "76-Tall", "77-Tall", "78-Tall", "79-Tall", "80-Tall",
-
-    #Big Sizes
-    "26B", "27B", "28B", "29B", "30B", "31B", "32B", "33B", "34B", "35B", "36B", "37B", "38B", "39B", "40B", "41B", "42B", "43B",
-    "44B", "45B", "46B", "47B", "48B", "49B", "50B", "51B", "52B", "53B", "54B", "55B", "56B", "57B", "58B", "59B", "60B", "61B",
-    "62B", "63B", "64B", "65B", "66B", "67B", "68B", "69B", "70B", "71B", "72B", "73B", "74B", "75B", "76B", "77B", "78B", "79B", "80B",
-
-    "26 B", "27 B", "28 B", "29 B", "30 B", "31 B", "32 B", "33 B", "34 B", "35 B", "36 B", "37 B", "38 B", "39 B", "40 B", "41 B", "42 B", "43 B",
-    "44 B", "45 B", "46 B", "47 B", "48 B", "49 B", "50 B", "51 B", "52 B", "53 B", "54 B", "55 B", "56 B", "57 B", "58 B", "59 B", "60 B", "61 B",
-    "62 B", "63 B", "64 B", "65 B", "66 B", "67 B", "68 B", "69 B", "70 B", "71 B", "72 B", "73 B", "74 B", "75 B", "76 B", "77 B", "78 B", "79 B", "80 B",
-
-    "26 Big", "27 Big", "28 Big", "29 Big", "30 Big", "31 Big", "32 Big", "33 Big", "34 Big", "35 Big", "36 Big", "37 Big", "38 Big", "39 Big", "40 Big", "41 Big", "42 Big", "43 Big",
-    "44 Big", "45 Big", "46 Big", "47 Big", "48 Big", "49 Big", "50 Big", "51 Big", "52 Big", "53 Big", "54 Big", "55 Big", "56 Big", "57 Big", "58 Big", "59 Big", "60 Big", "61 Big",
-    "62 Big", "63 Big", "64 Big", "65 Big", "66 Big", "67 Big", "68 Big", "69 Big", "70 Big", "71 Big", "72 Big", "73 Big", "74 Big", "75 Big", "76 Big", "77 Big", "78 Big", "79 Big", "80 Big",
-
-    "26-Big", "27-Big", "28-Big", "29-Big", "30-Big", "31-Big", "32-Big", "33-Big", "34-Big", "35-Big", "36-Big", "37-Big", "38-Big", "39-Big", "40-Big", "41-Big", "42-Big", "43-Big",
-    "44-Big", "45-Big", "46-Big", "47-Big", "48-Big", "49-Big", "50-Big", "51-Big", "52-Big", "53-Big", "54-Big", "55-Big", "56-Big", "57-Big", "58-Big", "59-Big", "60-Big", "61-Big",
-    "62-Big", "63-Big", "64-Big", "65-Big", "66-Big", "67-Big", "68-Big", "69-Big", "70-Big", "71-Big", "72-Big", "73-Big", "74-Big", "75-Big", "76-Big", "77-Big", "78-Big", "79-Big", "80-Big",
-
-    #Short Sizes 
-    "26S", "27S", "28S", "29S", "30S", "31S", "32S", "33S", "34S", "35S", "36S", "37S", "38S", "39S", "40S", "41S", "42S", "43S",
-    "44S", "45S", "46S", "47S", "48S", "49S", "50S", "51S", "52S", "53S", "54S", "55S", "56S", "57S", "58S", "59S", "60S", "61S",
-    "62S", "63S", "64S", "65S", "66S", "67S", "68S", "69S", "70S", "71S", "72S", "73S", "74S", "75S", "76S", "77S", "78S", "79S", "80S",
-
-    #XT Sizes
-    "26XT", "27XT", "28XT", "29XT", "30XT", "31XT", "32XT", "33XT", "34XT", "35XT", "36XT", "37XT", "38XT", "39XT", "40XT", "41XT", "42XT", "43XT",
-    "44XT", "45XT", "46XT", "47XT", "48XT", "49XT", "50XT", "51XT", "52XT", "53XT", "54XT", "55XT", "56XT", "57XT", "58XT", "59XT", "60XT", "61XT",
-    "62XT", "63XT", "64XT", "65XT", "66XT", "67XT", "68XT", "69XT", "70XT", "71XT", "72XT", "73XT", "74XT", "75XT", "76XT", "77XT", "78XT", "79XT", "80XT",
-
-    "26 Extra Tall", "27 Extra Tall", "28 Extra Tall", "29 Extra Tall", "30 Extra Tall", "31 Extra Tall", "32 Extra Tall", "33 Extra Tall", "34 Extra Tall", "35 Extra Tall", "36 Extra Tall", "37 Extra Tall", "38 Extra Tall", "39 Extra Tall", "40 Extra Tall", "41 Extra Tall", "42 Extra Tall", "43 Extra Tall",
-    "44 Extra Tall", "45 Extra Tall", "46 Extra Tall", "47 Extra Tall", "48 Extra Tall", "49 Extra Tall", "50 Extra Tall", "51 Extra Tall", "52 Extra Tall", "53 Extra Tall", "54 Extra Tall", "55 Extra Tall", "56 Extra Tall", "57 Extra Tall", "58 Extra Tall", "59 Extra Tall", "60 Extra Tall", "61 Extra Tall",
-    "62 Extra Tall", "63 Extra Tall", "64 Extra Tall", "65 Extra Tall", "66 Extra Tall", "67 Extra Tall", "68 Extra Tall", "69 Extra Tall", "70 Extra Tall", "71 Extra Tall", "72 Extra Tall", "73 Extra Tall", "74 Extra Tall", "75 Extra Tall", "76 Extra Tall", "77 Extra Tall", "78 Extra Tall", "79 Extra Tall", "80 Extra Tall",
-
-    #XLT Sizes
-    "26XLT", "27XLT", "28XLT", "29XLT", "30XLT", "31XLT", "32XLT", "33XLT", "34XLT", "35XLT", "36XLT", "37XLT", "38XLT", "39XLT", "40XLT", "41XLT", "42XLT", "43XLT",
-    "44XLT", "45XLT", "46XLT", "47XLT", "48XLT", "49XLT", "50XLT", "51XLT", "52XLT", "53XLT", "54XLT", "55XLT", "56XLT", "57XLT", "58XLT", "59XLT", "60XLT", "61XLT",
-    "62XLT", "63XLT", "64XLT", "65XLT", "66XLT", "67XLT", "68XLT", "69XLT", "70XLT", "71XLT", "72XLT", "73XLT", "74XLT", "75XLT", "76XLT", "77XLT", "78XLT", "79XLT", "80XLT",
-
-    # W sizes (waist)
-    "28w", "30w", "32w", "34w", "36w", "38w", "40w", "42w", "44w", "46w", "48w", "50w", "52w", "54w",
-
-    # Neck sizes
-    "14", "14.5", "15", "15.5", "16", "16.5", "17", "17.5", "18", "18.5", "19", "19.5", "20",
-
-    # Neck x Sleeve combinations
-    "14x32", "15x32", "15x33", "15x34", "15.5x33", "15.5x34", "16x34", "16x35", "16.5x35",
-    "17x34", "17x35", "17.5x34", "17.5x35", "18x34", "18.5x35", "19x36",
-
-    # European sizes
-    "eu32", "eu34", "eu36", "eu38", "eu40", "eu42", "eu44", "eu46", "eu48", "eu50",
 
-    # UK sizes
-    "uk4", "uk6", "uk8", "uk10", "uk12", "uk14", "uk16", "uk18", "uk20", "uk22", "uk24", "uk26", "uk28", "uk30",
+def _half_sizes(size):
+    return size.replace(" 1/2", ".5")
 
-    # Miscellaneous
-   # "one size", "os", "osfm", "free size", "plus", "custom", "made to measure"
 
-}
+def parse_size(text):
+    """Parse a size string into a SizeSpec, or None if it is not a size.
 
+    parse_size("32 x 34") -> SizeSpec("waist", "32x34", 32, 34, None, None)
+    parse_size("2xlt")    -> SizeSpec("alpha", "2xl", None, None, None, "tall")
+    parse_size("x-large") -> SizeSpec("alpha", "xl", None, None, None, None)
+    A bare "34" is "numeric": it could be a waist, a dress or an EU shoe size.
+    """
+    text = _alpha_words(" ".join(str(text).lower().split()).rstrip(" /"))
+    for system, rule in _SIZE_RULES:
+        match = rule.fullmatch(text)
+        if not match:
+            continue
+        parts = match.groupdict()
+        fit = FIT_ALIASES.get(parts.get("fit"))
+        if system == "waist":
+            waist, inseam = int(parts["waist"]), parts.get("inseam")
+            label = f"{waist}x{inseam}" if inseam else str(waist)
+            return SizeSpec(system, label, waist, int(inseam) if inseam else None, None, fit)
+        if system == "neck":
+            return SizeSpec(system, f"{parts['neck']}x{parts['sleeve']}", None, None, None, None)
+        if system == "alpha":
+            label = "/".join(p for p in (parts["label"], parts.get("label2")) if p) or None
+            return SizeSpec(system, label, None, None, None, fit)
+        width = parts.get("width")
+        return SizeSpec(system, _half_sizes(parts["size"]), None, None, "w" if width == "wide" else width, None)
+    return None
+
+
+# Inseam measurements, in one pattern: 34", 34 in/inch, 34.5", 34 1/2",
+# 86 cm, "inseam: 34", 34 inseam, L34 / 34L and the inseam half of 32x34.
+# A bare 34L is also the size grammar's waist-plus-Long (and a blazer's 42L),
+# so it only counts when its text also says inseam or length.
+_INSEAM_NUMBER = r"\d{2,3}(?:\.\d{1,2}|[ -]\d/\d)?"
+_INSEAM_UNIT = r"\"|''|in|inch(?:es)?|cm"
+INSEAM_PATTERN = re.compile(
+    rf"""
+    (?<![a-z0-9.])
+    (?:
+        inseam[ \t]*[:=-]?[ \t]*(?P<labelled>{_INSEAM_NUMBER})[ \t]*(?P<labelled_unit>{_INSEAM_UNIT})?
+      | (?P<measured>{_INSEAM_NUMBER})[ \t]*(?P<measured_unit>{_INSEAM_UNIT})(?:[ \t]*inseam)?
+      | (?P<suffixed>{_INSEAM_NUMBER})[ \t]*inseam
+      | l(?P<length_prefix>\d{{2}})
+      | (?P<length_suffix>\d{{2}})l
+      | [2-9]\d[ \t]*x[ \t]*(?P<waist_by>{_INSEAM_NUMBER})(?:[ \t]*l)?
+    )
+    (?![a-z0-9])
+    """,
+    re.VERBOSE,
+)
+INSEAM_RANGE = (20, 50)
+
+
+def _inseam_inches(number, unit):
+    whole, _, fraction = number.replace("-", " ").partition(" ")
+    value = float(whole)
+    if fraction:
+        numerator, denominator = fraction.split("/")
+        value += int(numerator) / int(denominator)
+    if unit == "cm":
+        value /= 2.54
+    value = round(value * 4) / 4  # nearest quarter inch
+    return int(value) if value.is_integer() else value
+
+
+def extract_inseam(sources):
+    """Inseam across (source, text) pairs, scanned in order in a single pass.
+
+    Returns (inches, source), e.g. (34, "option2") or (32.5, "variant_title"),
+    or (None, None). Text is expected lowercased.
+    """
+    names, texts = zip(*sources) if sources else ((), ())
+    # Scan everything in one pass; "\n" keeps matches from spanning sources
+    text = "\n".join(texts)
+    starts, offset = [], 0
+    for part in texts:
+        starts.append(offset)
+        offset += len(part) + 1
+    # A measurement that says "inseam" beats an earlier bare 30" or 32x34
+    found = None
+    for match in INSEAM_PATTERN.finditer(text):
+        parts = match.groupdict()
+        name = next(n for n in ("labelled", "measured", "suffixed", "length_prefix", "length_suffix", "waist_by") if parts[n])
+        inches = _inseam_inches(parts[name], parts.get(name + "_unit"))
+        if not INSEAM_RANGE[0] <= inches <= INSEAM_RANGE[1]:
+            continue
+        index = bisect.bisect_right(starts, match.start()) - 1
+        if name == "length_suffix" and "inseam" not in texts[index] and "length" not in texts[index]:
+            continue
+        source = names[index]
+        if "inseam" in match.group():
+            return inches, source
+        found = found or (inches, source)
+    return found or (None, None)
+
+
+
+class TermMatcher:
+    # Aho-Corasick automaton over several labelled vocabularies. One scan of a
+    # string reports, per label, the best whole-word hit: longest first, then
+    # the order the terms were given in. Word boundaries are only enforced on
+    # alphanumeric ends, so '34"' still matches inside '34" inseam'.
+    __slots__ = ("_goto", "_fail", "_out")
+
+    def __init__(self, vocabularies):
+        self._goto = [{}]
+        self._out = [[]]
+        for label, terms in vocabularies.items():
+            for rank, term in enumerate(terms):
+                node = 0
+                for ch in term:
+                    nxt = self._goto[node].get(ch)
+                    if nxt is None:
+                        nxt = len(self._goto)
+                        self._goto[node][ch] = nxt
+                        self._goto.append({})
+                        self._out.append([])
+                    node = nxt
+                self._out[node].append((label, term, len(term), rank))
+
+        # Breadth-first failure links; each node inherits its suffixes' outputs
+        self._fail = [0] * len(self._goto)
+        pending = deque(self._goto[0].values())
+        while pending:
+            node = pending.popleft()
+            for ch, nxt in self._goto[node].items():
+                pending.append(nxt)
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(ch, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def scan(self, text):
+        goto, fail, out = self._goto, self._fail, self._out
+        best = {}
+        node = 0
+        last = len(text) - 1
+        for end, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            for label, term, length, rank in out[node]:
+                start = end - length + 1
+                if term[0].isalnum() and start > 0 and text[start - 1].isalnum():
+                    continue
+                if term[-1].isalnum() and end < last and text[end + 1].isalnum():
+                    continue
+                current = best.get(label)
+                if current is None or (-length, rank) < (-current[1], current[2]):
+                    best[label] = (term, length, rank)
+        return {label: hit[0] for label, hit in best.items()}
+
+
+class SizeLexicon:
+    # Lowercased, precomputed views of the length/colour vocabularies.
+    # Built once per container instead of once per variant; treat as read-only.
+    __slots__ = ("length_terms", "color_keywords", "title_matcher")
+
+    def __init__(self, length_terms, color_keywords):
+        self.length_terms = tuple(sorted({t.lower() for t in length_terms}, key=lambda x: (-len(x), x)))
+        self.color_keywords = tuple(c.lower() for c in color_keywords)
+        # Sizes go through SIZE_SEARCH; colour shades tie-break in declared order
+        self.title_matcher = TermMatcher({
+            "length": self.length_terms,
+            "color": self.color_keywords,
+        })
+
+
+# Compiled rule files. `sources` keeps the raw bytes of each file and
+# `digest` their hash, which keys the /tmp cache; `etags` is None for the
+# packaged copies.
+Rules = namedtuple("Rules", [
+    "digest", "etags", "sources", "categories", "category_index",
+    "length_terms", "color_synonyms", "size_lexicon", "color_matcher",
+])
+
+
+def _nonempty_strings(values):
+    return isinstance(values, list) and all(isinstance(v, str) and v.strip() for v in values)
+
+
+def validate_rules(name, document):
+    if not isinstance(document, dict) or document.get("version") != RULES_VERSION:
+        raise ValueError(f"{name}: expected a version {RULES_VERSION} document")
+    if name == "categories":
+        categories = document.get("categories")
+        if not isinstance(categories, dict) or not categories:
+            raise ValueError(f"{name}: 'categories' must be a non-empty object")
+        for primary, sub_map in categories.items():
+            if not isinstance(sub_map, dict):
+                raise ValueError(f"{name}: {primary} must map subcategories to keyword lists")
+            for sub, keywords in sub_map.items():
+                if not _nonempty_strings(keywords):
+                    raise ValueError(f"{name}: {primary}/{sub} must be a list of keywords")
+                for keyword in keywords:
+                    if not 1 <= len(tokenize(keyword)) <= 3:
+                        raise ValueError(f"{name}: {keyword!r} must be one to three words")
+    elif name == "size_lexicon":
+        if not _nonempty_strings(document.get("length_terms")):
+            raise ValueError(f"{name}: 'length_terms' must be a list of terms")
+        synonyms = document.get("color_synonyms")
+        if not isinstance(synonyms, dict) or not _nonempty_strings(list(synonyms) + list(synonyms.values())):
+            raise ValueError(f"{name}: 'color_synonyms' must map shades to colour families")
+    else:
+        raise ValueError(f"Unknown rule file: {name}")
+
+
+def compile_rules(sources, etags):
+    digest = hashlib.sha256(b"\0".join([
+        f"{RULES_VERSION}:{RULES_CODE_FINGERPRINT}".encode(), *(sources[name] for name in RULE_FILES),
+    ])).hexdigest()
+    cached = _load_compiled_rules(digest)
+    if cached is not None:
+        return cached._replace(etags=etags)
+
+    documents = {name: json.loads(sources[name]) for name in RULE_FILES}
+    for name, document in documents.items():
+        validate_rules(name, document)
+    categories = documents["categories"]["categories"]
+    length_terms = frozenset(documents["size_lexicon"]["length_terms"])
+    # Shade -> colour family. Matched as whole words, longest shade first, so
+    # "navy blue" is Navy and "light blue" is Blue.
+    color_synonyms = {shade.lower(): family for shade, family in documents["size_lexicon"]["color_synonyms"].items()}
+    size_lexicon = SizeLexicon(length_terms, color_synonyms)
+    rules = Rules(
+        digest, etags, sources, categories, CategoryIndex(categories), length_terms, color_synonyms,
+        size_lexicon, TermMatcher({"color": size_lexicon.color_keywords}),
+    )
+    _save_compiled_rules(rules)
+    return rules
 
-   length_terms = { "tall", "extra tall", "short", "petite", "regular", "big", "big and tall",
-       "med", "medium", "xlong", "long", "portly regular", "portly long",
-       "wide-2e", "wide-3e", "wide-5e", "xwide-3e", "xwide-5e", "xxwide-3e", "xxwide-5e" }
-   
-   inseam_terms = { 
-    "/ 28\" Inseam", "/ 30\" Inseam", "/ 32\" Inseam", "/ 34\" Inseam", "/ 35\" Inseam", "/ 36\" Inseam", "/ 37\" Inseam", "/ 38\" Inseam",
-    "28\" Inseam",  "30\" Inseam",  "32\" Inseam",  "34\" Inseam",  "35\" Inseam",  "36\" Inseam",  "37\" Inseam",  "38\" Inseam",
-    
-    "28\"", "30\"", "34\"","35\"", "36\"","37\"", "38\"",
-    "28 inch","30 inch","32 inch","34 inch","35 inch", "36 inch","37 inch", "38 inch",
-    "28 in", "30 in", "32 in","34 in", "36 in", "38 in",
-    "28\" inseam","30\" inseam","32\" inseam", "34\" inseam", "36\" inseam", "38\" inseam",
-    "inseam 28","inseam 30", "inseam 32", "inseam 34", "inseam 35", "inseam: 36", "inseam 37", "38 inseam",
-    
-}
-       
 
+def _load_compiled_rules(digest=None):
+    # The last compiled rules, if this code compiled them and they are the
+    # ones asked for
+    if not RULES_CACHE_PATH:
+        return None
+    try:
+        with open(RULES_CACHE_PATH, "rb") as f:
+            version, fingerprint, rules = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"⚠️ Ignoring compiled rules cache: {e}")
+        return None
+    if (version, fingerprint) != (RULES_VERSION, RULES_CODE_FINGERPRINT):
+        return None
+    if not isinstance(rules, Rules) or digest not in (None, rules.digest):
+        return None
+    return rules
+
+
+def _save_compiled_rules(rules):
+    if not RULES_CACHE_PATH:
+        return
+    try:
+        tmp_path = RULES_CACHE_PATH + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump((RULES_VERSION, RULES_CODE_FINGERPRINT, rules), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, RULES_CACHE_PATH)
+    except Exception as e:
+        print(f"⚠️ Could not cache compiled rules: {e}")
 
-   for val in option_values:
-       if not val:
-           continue
-       val_clean = val.replace("&", "and")
-       if val_clean in alpha_sizes:
-           size = val
-       elif any(term in val_clean for term in length_terms):
-           length = val
-       elif any(color in val_clean for color in color_keywords):
-           color = val
-
-
-   title = str(variant.get("title", "")).lower()
-
-   if not size:
-    sorted_sizes = sorted(alpha_sizes, key=lambda x: -len(x))  # prioritize longer strings
-    for s in sorted_sizes:
-        if s.lower() in title:
-            size = s.upper()
-            break
-   if not color and any(x in title for x in color_keywords):
-       color = next((x.title() for x in color_keywords if x in title), None)
-   if not length and any(x in title for x in length_terms):
-       length = next((x.title() for x in length_terms if x in title), None)
 
+_rules_state = {"rules": None, "checked_at": 0.0}
+_rules_lock = threading.Lock()
 
-   if size and "big" in size.lower():
-       length = "Big & Tall"
-       size = None
 
-   # Inseam detection from known patterns
-   for val in option_values + [variant_title, product_title]:
-        if not val:
-            continue
-        val_lower = val.lower().strip()
-        for term in inseam_terms:
-            if term.lower() in val_lower:
-                match = re.search(r'\d{2}', term)
-                if match:
-                    try:
-                        inseam_candidate = int(match.group())
-                        if 20 <= inseam_candidate <= 50:
-                            inseam = inseam_candidate
-                            break
-                    except:
-                        continue
-        if inseam:
-            break
+def install_rules(rules):
+    """Make `rules` the ones every mapper uses.
 
-   return {"size": size, "color": color, "length": length, "inseam": inseam}
+    Memoised variant mappings and option classifications were produced by
+    the previous rules, so they are dropped whenever the rule files actually
+    changed.
+    """
+    global CATEGORY_KEYWORDS, CATEGORY_INDEX, LENGTH_TERMS, COLOR_SYNONYMS, SIZE_LEXICON, COLOR_MATCHER
+    previous = _rules_state["rules"]
+    _rules_state["rules"] = rules
+    CATEGORY_KEYWORDS, CATEGORY_INDEX = rules.categories, rules.category_index
+    LENGTH_TERMS, COLOR_SYNONYMS = rules.length_terms, rules.color_synonyms
+    SIZE_LEXICON, COLOR_MATCHER = rules.size_lexicon, rules.color_matcher
+    if previous is not None and previous.digest != rules.digest:
+        _variant_cache.clear()
+        _option_kinds.clear()
+        sources = ", ".join(f"{name}={etag or 'package'}" for name, etag in rules.etags.items())
+        print(f"📐 Installed rules {rules.digest[:12]} ({sources})")
 
 
-def lambda_handler(event, context):
-    key = event["Records"][0]["s3"]["object"]["key"]
-    print(f"Lambda triggered for key: {key}")
-    time.sleep(1.5)
+def current_rules():
+    return _rules_state["rules"]
+
 
+def _packaged_rule_file(name):
+    with open(os.path.join(RULES_DIR, f"{name}.json"), "rb") as f:
+        return f.read()
+
+
+def _fetch_rule_file(name, etag):
+    # (bytes, etag) of the S3 override, None if it still matches `etag`,
+    # or the packaged copy when there is no override
     try:
-        obj = s3.get_object(Bucket=BUCKET_NAME, Key=key)
+        extra = {"IfNoneMatch": f'"{etag}"'} if etag else {}
+        obj = s3.get_object(Bucket=BUCKET_NAME, Key=f"{RULES_S3_PREFIX}/{name}.json", **extra)
     except s3.exceptions.NoSuchKey:
-        print(f"❌ No such key in bucket: {key}")
+        return _packaged_rule_file(name), None
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("304", "NotModified"):
+            return None
         raise
+    return obj["Body"].read(), _normalize_etag(obj["ETag"])
+
+
+def refresh_rules(force=False):
+    # Re-check the S3 rule files if RULES_CHECK_INTERVAL has passed. A file
+    # that fails to load or validate leaves the current rules in place.
+    if not RULES_S3_PREFIX:
+        return current_rules()
+    with _rules_lock:
+        if not force and time.monotonic() - _rules_state["checked_at"] < RULES_CHECK_INTERVAL:
+            return current_rules()
+        _rules_state["checked_at"] = time.monotonic()
+        rules = current_rules()
+        sources, etags = dict(rules.sources), dict(rules.etags)
+        try:
+            for name in RULE_FILES:
+                fetched = _fetch_rule_file(name, etags[name])
+                if fetched is not None:
+                    sources[name], etags[name] = fetched
+            if sources != rules.sources or etags != rules.etags:
+                install_rules(compile_rules(sources, etags))
+        except Exception as e:
+            print(f"⚠️ Keeping rules {rules.digest[:12]}; could not load new rule files: {e}")
+    return current_rules()
+
+
+def _initial_rules():
+    # The rules this container's /tmp last compiled, so refresh_rules() can
+    # revalidate them by ETag; else the packaged files. Cached packaged files
+    # are only reused if the deployment still ships the same ones.
+    packaged = {name: _packaged_rule_file(name) for name in RULE_FILES}
+    cached = _load_compiled_rules() if RULES_S3_PREFIX else None
+    if cached is not None and all(cached.etags.get(name) or cached.sources.get(name) == packaged[name] for name in RULE_FILES):
+        return cached
+    return compile_rules(packaged, {name: None for name in RULE_FILES})
+
+
+install_rules(_initial_rules())
+
+
+def match_color(text):
+    # (family, shade) for the longest colour word in text, e.g.
+    # "Charcoal Heather" -> ("Gray", "charcoal"), or (None, None)
+    shade = COLOR_MATCHER.scan(str(text).lower()).get("color")
+    return (COLOR_SYNONYMS[shade], shade) if shade else (None, None)
+
+
+_variant_cache = LRUCache(VARIANT_CACHE_MAX_ENTRIES)
+# _classify_option results per distinct option string ("32", "black"), shared
+# by every product in a file and across warm invocations
+_option_kinds = LRUCache(VARIANT_CACHE_MAX_ENTRIES)
+
+
+# Shopify option names -> the field their values belong to
+OPTION_NAME_FIELDS = {
+    "size": "size", "sizes": "size", "shoe size": "size",
+    # Mapped as size, but a bare number under them is known to be a waist
+    "waist": "waist", "waist size": "waist",
+    "color": "color", "colour": "color", "colors": "color", "wash": "color", "shade": "color",
+    "length": "length", "fit": "length", "height": "length", "leg": "length",
+    "inseam": "inseam", "inseam length": "inseam", "leg length": "inseam",
+}
+# 34, 34.5, 34 1/2 or 34L under an option named Inseam
+_BARE_INSEAM = re.compile(r"(\d{2}(?:\.\d{1,2}| \d/\d)?)l?")
 
-    raw_lines = obj["Body"].read().decode("utf-8").strip().splitlines()
-    rows = []
 
-    for i, line in enumerate(raw_lines):
-        line = line.strip()
+def option_fields(options):
+   # (field or None) for option1..3 from a product's `options`, which Shopify
+   # sends as [{"name": "Size", "position": 1}, ...] or as plain names
+   fields = [None, None, None]
+   for index, option in enumerate(options or []):
+       if isinstance(option, dict):
+           name, position = option.get("name"), option.get("position") or index + 1
+       else:
+           name, position = option, index + 1
+       if isinstance(position, int) and 1 <= position <= 3 and name:
+           fields[position - 1] = OPTION_NAME_FIELDS.get(" ".join(str(name).lower().split()))
+   return tuple(fields)
+
+
+def smart_map_variant(variant, product_title="", options=None):
+   return smart_map_variants([variant], product_title, options)[0]
+
+
+def smart_map_variants(variants, product_title="", options=None, profile=None, vendor=None):
+   # Maps a batch of variants (a product, or a whole file) at once. Identical
+   # option/title tuples are mapped once, and each distinct option string is
+   # classified once (_option_kinds) however many products share it. A vendor
+   # profile fills in the options the product's own option names don't cover.
+   product_title = str(product_title).strip().lower()
+   fields = option_fields(options)
+   if profile:
+       fields = tuple(field or learned for field, learned in zip(fields, profile))
+   batch = {}
+   mapped_variants = []
+   for variant in variants:
+       key = _variant_key(variant, product_title, fields)
+       mapped = batch.get(key)
+       elapsed = 0.0
+       if mapped is None:
+           mapped = _variant_cache.get(key)
+           if mapped is None:
+               started = time.perf_counter()
+               mapped = _map_variant(list(key[:3]), key[3], key[4], fields)
+               elapsed = time.perf_counter() - started
+               _variant_cache.put(key, mapped)
+           batch[key] = mapped
+       record_option_issues(vendor, key[:3], mapped, elapsed)
+       # Callers get their own copy; the cached dict is shared across rows
+       mapped_variants.append(dict(mapped))
+   return mapped_variants
+
+
+def _variant_key(variant, product_title, fields):
+   option_keys = ["option1", "option2", "option3"]
+   return (
+       *(str(variant.get(k) or "").strip().lower() for k in option_keys),
+       str(variant.get("title", "")).strip().lower(),
+       product_title,
+       fields,
+   )
+
+
+def _classify_option(val):
+   # Every lexicon the value matches, in priority order (size, length, color)
+   val_clean = val.replace("&", "and")
+   return tuple(field for field in ("size", "length", "color") if _OPTION_PARSERS[field](val_clean))
+
+
+_OPTION_PARSERS = {
+   "size": parse_size,
+   "color": lambda val: match_color(val)[0],
+   "length": lambda val: any(term in val for term in SIZE_LEXICON.length_terms),
+}
+
+
+def _routed_inseam(val):
+   bare = _BARE_INSEAM.fullmatch(val)
+   if bare:
+       inches = _inseam_inches(bare.group(1), None)
+       return inches if INSEAM_RANGE[0] <= inches <= INSEAM_RANGE[1] else None
+   return extract_inseam([("", val)])[0]
+
+
+def _map_variant(option_values, variant_title, product_title, option_fields=(None, None, None)):
+   lexicon = SIZE_LEXICON
+
+   # Options under a recognised name go straight to that field's parser. The
+   # full lexicon scan only runs for unnamed options and for values the named
+   # parser rejects; if that finds nothing either, the name is trusted. The
+   # scan never replaces a field a recognised name already filled, and a
+   # number under Length ("30", "36L") is tried as an inseam first.
+   # Later options win, as before.
+   fields = {}
+   named = set()  # fields filled by an option's own name
+   routes = [None, None, None]  # the field each option ended up in
+   issues = [None, None, None]  # telemetry: (issue, candidate fields) per option
+   routed_inseam = None
+   for position, (val, field) in enumerate(zip(option_values, option_fields), 1):
+       if not val:
+           continue
+       if field == "waist":
+           field = "size"
+       if field and field != "inseam" and _OPTION_PARSERS[field](val.replace("&", "and")):
+           fields[field] = val
+           named.add(field)
+           routes[position - 1] = field
+           continue
+       if field in ("inseam", "length"):
+           inches = _routed_inseam(val)
+           if inches is not None:
+               routed_inseam = (inches, f"option{position}")
+               routes[position - 1] = "inseam"
+               # "34 x 36" under Inseam still carries the waist; a bare "32"
+               # parses as a numeric size too but is only the inseam
+               spec = parse_size(val)
+               if spec and spec.system == "waist" and spec.inseam is not None and "size" not in named:
+                   fields["size"] = val
+               continue
+       found = _option_kinds.get(val)
+       if found is None:
+           found = _classify_option(val)
+           _option_kinds.put(val, found)
+       kinds = tuple(kind for kind in found if kind not in named)
+       if found and not kinds:
+           # Recognised, but as a field a named option already holds ("32"
+           # under Color next to a Size option); not a colour either
+           issues[position - 1] = ("unmapped", ())
+       elif kinds:
+           fields[kinds[0]] = val
+           routes[position - 1] = kinds[0]
+           if len(kinds) > 1:
+               issues[position - 1] = ("ambiguous", kinds)
+       elif field and field != "inseam" and extract_inseam([("", val)])[0] is None:
+           fields[field] = val
+           routes[position - 1] = field
+           issues[position - 1] = ("name_only", (field,))
+       else:
+           issues[position - 1] = ("unmapped", ())
+   size, color, length = fields.get("size"), fields.get("color"), fields.get("length")
+   # A bare "32" is only known to be a waist if it came from an option named Waist
+   waist_option = bool(size) and any(
+       field == "waist" and val == size for val, field in zip(option_values, option_fields)
+   )
+   size_spec = parse_size(size) if size else None
+   color_family = match_color(color)[0] if color else None
+
+
+   title = variant_title
+
+   if not (size and color and length):
+       found = lexicon.title_matcher.scan(title)  # longest whole-word hit per field
+       if not size:
+           # Values already taken as the inseam ("34L" under Inseam) aren't sizes
+           inseams = {val for val, route in zip(option_values, routes) if route == "inseam"}
+           sizes = [m.group() for m in SIZE_SEARCH.finditer(title) if m.group() not in inseams]
+           if sizes:
+               # "Size 10 Wide" is stored as "10 WIDE", "X-Large" as "XL"
+               size = _alpha_words(max(sizes, key=len).removeprefix("size ")).upper()
+       if not color and "color" in found:
+           color = found["color"].title()
+           color_family = COLOR_SYNONYMS[found["color"]]
+       if not length and "length" in found:
+           length = found["length"].title()
+
+
+   if size and "big" in size.lower():
+       length = "Big & Tall"
+       size = None
+
+   inseam, inseam_source = routed_inseam or extract_inseam([
+       ("option1", option_values[0]), ("option2", option_values[1]), ("option3", option_values[2]),
+       ("variant_title", variant_title), ("product_title", product_title),
+   ])
+
+   if inseam_source and inseam_source.startswith("option") and not routes[int(inseam_source[-1]) - 1]:
+       routes[int(inseam_source[-1]) - 1] = "inseam"
+       issues[int(inseam_source[-1]) - 1] = None
+
+   return {
+       "size": size, "color": color, "color_family": color_family, "length": length,
+       "inseam": inseam, "inseam_source": inseam_source,
+       "option_routes": tuple(routes), "size_format": size_spec.system if size_spec else None,
+       "waist_option": waist_option and size is not None,
+       "option_issues": tuple(issues),
+   }
+
+
+# Per-process option telemetry since the last write_option_report(), keyed
+# ("variants",), (issue, value, candidates, "count" | "seconds") and
+# (issue, value, candidates, "vendor", vendor); merged like the vendor tallies
+_option_telemetry = Counter()
+_telemetry_lock = threading.Lock()
+
+
+def record_option_issues(vendor, option_values, mapped, elapsed=0.0):
+   # `elapsed` is the time _map_variant took, charged to every problem value
+   # it had to scan for; memo hits cost nothing
+   with _telemetry_lock:
+       _option_telemetry[("variants",)] += 1
+       for val, found in zip(option_values, mapped["option_issues"]):
+           if not found:
+               continue
+           issue, candidates = found
+           _option_telemetry[(issue, val, candidates, "count")] += 1
+           if elapsed:
+               _option_telemetry[(issue, val, candidates, "seconds")] += elapsed
+           if vendor:
+               _option_telemetry[(issue, val, candidates, "vendor", str(vendor))] += 1
+
+
+def drain_option_telemetry():
+   with _telemetry_lock:
+       telemetry = dict(_option_telemetry)
+       _option_telemetry.clear()
+   return telemetry
+
+
+def merge_option_telemetry(telemetry):
+   with _telemetry_lock:
+       _option_telemetry.update(telemetry)
+
+
+def option_report(telemetry):
+   """Collapse a telemetry tally into the report document.
+
+   Values are sorted by how often they were seen, capped at
+   OPTION_TELEMETRY_MAX_VALUES, and keep their top vendors as examples.
+   """
+   entries = {}
+   for key, amount in telemetry.items():
+       if key == ("variants",):
+           continue
+       issue, val, candidates, kind, *vendor = key
+       entry = entries.setdefault((issue, val, candidates), {
+           "issue": issue, "value": val, "candidates": list(candidates), "count": 0, "seconds": 0.0, "vendors": Counter(),
+       })
+       if kind == "vendor":
+           entry["vendors"][vendor[0]] += amount
+       else:
+           entry[kind] += amount
+   values = sorted(entries.values(), key=lambda e: (-e["count"], e["issue"], e["value"]))
+   for entry in values:
+       entry["seconds"] = round(entry["seconds"], 6)
+       entry["vendors"] = dict(entry["vendors"].most_common(OPTION_TELEMETRY_MAX_VENDORS))
+   return {
+       "version": OPTION_TELEMETRY_VERSION,
+       "variants": telemetry.get(("variants",), 0),
+       "distinct_values": len(values),
+       "values": values[:OPTION_TELEMETRY_MAX_VALUES],
+   }
+
+
+def write_option_report(run_id=None):
+   # One report per invocation; returns its key, or None if nothing was written
+   telemetry = drain_option_telemetry()
+   if not OPTION_TELEMETRY_PREFIX or not telemetry:
+       return None
+   now = datetime.now(timezone.utc)
+   report = option_report(telemetry)
+   report["generated_at"] = now.isoformat(timespec="seconds")
+   key = f"{OPTION_TELEMETRY_PREFIX}/{now:%Y-%m-%d}/{now:%H%M%S}-{run_id or uuid.uuid4().hex}.json"
+   try:
+       s3.put_object(
+           Bucket=BUCKET_NAME, Key=key,
+           Body=json.dumps(report, separators=(",", ":")).encode("utf-8"), ContentType="application/json",
+       )
+   except Exception as e:
+       print(f"⚠️ Could not save option telemetry: {e}")
+       return None
+   unmapped = sum(v["count"] for v in report["values"] if v["issue"] == "unmapped")
+   print(f"📊 Option telemetry: {report['distinct_values']} problem values, "
+         f"{unmapped} unmapped option uses in {report['variants']} variants -> {key}")
+   return key
+
+
+_vendor_profiles = {"loaded": False, "revision": 0, "profiles": {}}
+# Per-process tallies since the last update_vendor_profiles(); parallel
+# workers hand theirs back to the parent with each batch
+_vendor_observations = Counter()
+_vendor_lock = threading.Lock()
+
+
+def load_vendor_profiles():
+   with _vendor_lock:
+       if _vendor_profiles["loaded"]:
+           return
+       _vendor_profiles["loaded"] = True
+       if not VENDOR_PROFILES_S3_KEY:
+           return
+       try:
+           obj = s3.get_object(Bucket=BUCKET_NAME, Key=VENDOR_PROFILES_S3_KEY)
+           stored = json.loads(obj["Body"].read())
+       except s3.exceptions.NoSuchKey:
+           return
+       except Exception as e:
+           print(f"⚠️ Could not load vendor profiles: {e}")
+           return
+       if stored.get("version") != VENDOR_PROFILE_VERSION:
+           print(f"⚠️ Ignoring vendor profiles with version {stored.get('version')}")
+           return
+       _vendor_profiles["revision"] = stored.get("revision", 0)
+       _vendor_profiles["profiles"] = stored.get("profiles", {})
+       print(f"🧭 Loaded {len(_vendor_profiles['profiles'])} vendor profiles (revision {_vendor_profiles['revision']})")
+
+
+def vendor_profile(vendor):
+   # Learned option fields for an active vendor, or None
+   load_vendor_profiles()
+   profile = _vendor_profiles["profiles"].get(str(vendor))
+   if profile and profile["status"] == "active":
+       return tuple(profile["fields"])
+   return None
+
+
+def record_vendor_variant(vendor, mapped, profile=None):
+   vendor = str(vendor)
+   with _vendor_lock:
+       _vendor_observations[(vendor, "variants")] += 1
+       for position, field in enumerate(mapped["option_routes"], 1):
+           if field:
+               _vendor_observations[(vendor, "position", str(position), field)] += 1
+       if mapped["size_format"]:
+           _vendor_observations[(vendor, "format", mapped["size_format"])] += 1
+       if profile:
+           _vendor_observations[(vendor, "checked")] += 1
+           if any(route and learned and route != learned for route, learned in zip(mapped["option_routes"], profile)):
+               _vendor_observations[(vendor, "misses")] += 1
+
+
+def drain_vendor_observations():
+   with _vendor_lock:
+       observations = dict(_vendor_observations)
+       _vendor_observations.clear()
+   return observations
+
+
+def merge_vendor_observations(observations):
+   with _vendor_lock:
+       _vendor_observations.update(observations)
+
+
+def _learn_profile(profile):
+   # Every option position seen must go to one field at least MIN_SHARE of the time
+   fields = [None, None, None]
+   for position, counts in profile["positions"].items():
+       field, count = max(counts.items(), key=lambda item: item[1])
+       if count < VENDOR_PROFILE_MIN_SHARE * sum(counts.values()):
+           return None
+       fields[int(position) - 1] = field
+   return fields
+
+
+def update_vendor_profiles():
+   """Fold this run's observations into the profiles and persist them.
+
+   Returns the vendors flagged because their variants no longer fit their
+   profile. Concurrent containers overwrite each other's tallies (last
+   writer wins); the counts only need to be roughly right.
+   """
+   load_vendor_profiles()
+   observations = drain_vendor_observations()
+   if not observations:
+       return []
+   flagged = []
+   with _vendor_lock:
+       profiles = _vendor_profiles["profiles"]
+       for (vendor, kind, *detail), count in observations.items():
+           profile = profiles.setdefault(vendor, {
+               "status": "learning", "fields": None, "variants": 0, "positions": {}, "formats": {},
+               "checked": 0, "misses": 0,
+           })
+           if kind == "position":
+               position, field = detail
+               counts = profile["positions"].setdefault(position, {})
+               counts[field] = counts.get(field, 0) + count
+           elif kind == "format":
+               profile["formats"][detail[0]] = profile["formats"].get(detail[0], 0) + count
+           else:
+               profile[kind] += count
+
+       for vendor in {key[0] for key in observations}:
+           profile = profiles[vendor]
+           if profile["status"] == "active":
+               if (profile["checked"] >= VENDOR_PROFILE_MIN_CHECKED
+                       and profile["misses"] > VENDOR_PROFILE_MAX_MISS_RATE * profile["checked"]):
+                   print(f"🚩 {vendor}: {profile['misses']}/{profile['checked']} variants no longer fit its profile")
+                   flagged.append(vendor)
+                   profile.update(status="flagged", fields=None, variants=0, positions={}, formats={}, checked=0, misses=0)
+           elif profile["variants"] >= VENDOR_PROFILE_MIN_VARIANTS:
+               fields = _learn_profile(profile)
+               if fields:
+                   print(f"🧭 Learned profile for {vendor}: {fields}")
+                   profile.update(status="active", fields=fields, checked=0, misses=0)
+
+       _vendor_profiles["revision"] += 1
+       document = {"version": VENDOR_PROFILE_VERSION, "revision": _vendor_profiles["revision"], "profiles": profiles}
+       if VENDOR_PROFILES_S3_KEY:
+           try:
+               s3.put_object(
+                   Bucket=BUCKET_NAME, Key=VENDOR_PROFILES_S3_KEY,
+                   Body=json.dumps(document).encode("utf-8"), ContentType="application/json",
+               )
+           except Exception as e:
+               print(f"⚠️ Could not save vendor profiles: {e}")
+   return flagged
+
+
+def _alpha_rank(label):
+   ranks = []
+   for part in label.split("/"):
+       # 2xl -> xxl, 3xs -> xxxs; a bare 1x/2x plus size ranks as xl/xxl
+       match = re.fullmatch(r"(\d)x([sl]?)", part)
+       if match:
+           count = max(int(match.group(1)), 1)
+           part = "x" * count + (match.group(2) or "l")
+       if part not in ALPHA_SIZE_RANKS:
+           return None
+       ranks.append(ALPHA_SIZE_RANKS[part])
+   return _number(sum(ranks) / len(ranks))
+
+
+def _number(value):
+   value = float(value)
+   return int(value) if value.is_integer() else value
+
+
+def size_columns(mapped, primary_category=None):
+   # Numeric, indexable companions to the free-text size/length/inseam fields
+   spec = parse_size(mapped["size"]) if mapped.get("size") else None
+   length_term = SIZE_LEXICON.title_matcher.scan(mapped["length"].lower()).get("length") if mapped.get("length") else None
+   inseam = mapped.get("inseam") or (spec.inseam if spec else None)
+
+   waist = shoe_size = alpha_rank = width = None
+   waist_category = primary_category not in NON_WAIST_CATEGORIES
+   if spec:
+       if spec.system == "waist":
+           waist = spec.waist if waist_category else None
+       elif spec.system == "numeric" and primary_category == "Shoes" and float(spec.label) <= 18:
+           shoe_size = _number(spec.label)
+       elif (spec.system == "numeric" and waist_category and (inseam or mapped.get("waist_option"))
+             and 24 <= float(spec.label) <= 60):
+           # A bare 32 next to an inseam, or under an option named Waist, is a waist
+           waist = _number(spec.label)
+       elif spec.system == "us_shoe":
+           shoe_size = _number(spec.label)
+           width = spec.width.upper()
+       elif spec.system == "alpha":
+           alpha_rank = _alpha_rank(spec.label) if spec.label else None
+   if width is None and length_term:
+       match = re.search(r"(\d)e$", length_term)
+       width = f"{match.group(1)}E" if match else None
+
+   if mapped.get("length") == "Big & Tall":
+       fit_class = "big and tall"
+   else:
+       fit_class = (spec.fit if spec else None) or LENGTH_FIT_CLASSES.get(length_term)
+   return {
+       "waist_in": waist,
+       "inseam_in": inseam,
+       "alpha_size_rank": alpha_rank,
+       "shoe_size": shoe_size,
+       "width": width,
+       "fit_class": fit_class,
+   }
+
+
+def detect_compression(key, content_encoding=None):
+    encoding = (content_encoding or "").lower()
+    if encoding in ("gzip", "x-gzip") or key.endswith(".gz"):
+        return "gzip"
+    if encoding == "zstd" or key.endswith(".zst"):
+        return "zstd"
+    return None
+
+
+def _decompressor(compression):
+    if compression == "gzip":
+        return zlib.decompressobj(zlib.MAX_WBITS | 16)
+    if compression == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstandard is not installed; cannot read .zst objects")
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError(f"Unsupported compression: {compression}")
+
+
+def _compressor(compression):
+    if compression in (None, "none"):
+        return None
+    if compression == "gzip":
+        return zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    if compression == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstandard is not installed; cannot write .zst objects")
+        return zstandard.ZstdCompressor(level=3).compressobj()
+    raise ValueError(f"Unsupported compression: {compression}")
+
+
+def decompress_chunks(chunks, compression):
+    if compression is None:
+        yield from chunks
+        return
+    decompressor = _decompressor(compression)
+    for chunk in chunks:
+        # Concatenated gzip members / zstd frames each need a fresh decompressor
+        while chunk:
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+            if not decompressor.eof:
+                break
+            chunk = decompressor.unused_data
+            decompressor = _decompressor(compression)
+    data = decompressor.flush()
+    if data:
+        yield data
+
+
+def output_key_for(key, compression=None):
+    compression = compression or OUTPUT_COMPRESSION
+    for extension in COMPRESSION_EXTENSIONS.values():
+        if key.endswith(extension):
+            key = key[:-len(extension)]
+    output_key = key.replace(INPUT_PREFIX, OUTPUT_PREFIX).replace(".json", ".json")
+    return output_key + COMPRESSION_EXTENSIONS.get(compression, "")
+
+
+def iter_lines(chunks):
+    # Split a stream of byte chunks on newlines without joining the whole body
+    buffered = []
+    for chunk in chunks:
+        start = 0
+        while True:
+            end = chunk.find(b"\n", start)
+            if end == -1:
+                if start < len(chunk):
+                    buffered.append(chunk[start:])
+                break
+            buffered.append(chunk[start:end])
+            yield b"".join(buffered)
+            buffered = []
+            start = end + 1
+    if buffered:
+        yield b"".join(buffered)
+
+
+def iter_raw_products(lines, stats=None, first_line=1):
+    for i, line in enumerate(lines, first_line - 1):
+        line = line.decode("utf-8").strip()
         if not line:
             continue
         try:
-            rows.append(json.loads(line))
+            product = json.loads(line)
         except json.JSONDecodeError as e:
             print(f"❌ JSONDecodeError on line {i + 1}: {e} — line content: {line[:120]}")
             continue
+        if stats is not None:
+            stats["products"] = stats.get("products", 0) + 1
+        yield product
 
-    flattened = []
 
-    for row in rows:
-        variants = row.get("variants", [])
-        if not isinstance(variants, list):
-            continue
+def flatten_product(row):
+    variants = row.get("variants", [])
+    if not isinstance(variants, list):
+        return
 
 
-        # Fallback: if vendor is a number, use brand name from store URL
+    # Fallback: if vendor is a number, use brand name from store URL
+    store_url = row.get("store", "")
+    raw_vendor = row.get("vendor", "")
+    if isinstance(raw_vendor, str) and raw_vendor.isdigit():
         store_url = row.get("store", "")
-        raw_vendor = row.get("vendor", "")
-        if isinstance(raw_vendor, str) and raw_vendor.isdigit():
-            store_url = row.get("store", "")
-            fallback_vendor = store_url.replace("https://", "").replace("www.", "").split(".")[0]
-            fallback_vendor = fallback_vendor.replace("-", " ").title()
-            vendor = fallback_vendor
-        else:
-            vendor = raw_vendor
-
-        common_data = {
-            "product_title": row.get("title"),
-            "description": clean_html(row.get("body_html", "")),
-            "image_url": extract_first_image(row.get("images", [])),
-            "category": row.get("product_type"),
-            "vendor": vendor,
-            "product_url": f"{store_url}/products/{row.get('handle')}",
-
-            #"vendor": row.get("vendor"),
-            # "tags": row.get("tags"),
+        fallback_vendor = store_url.replace("https://", "").replace("www.", "").split(".")[0]
+        fallback_vendor = fallback_vendor.replace("-", " ").title()
+        vendor = fallback_vendor
+    else:
+        vendor = raw_vendor
+
+    common_data = {
+        "product_title": row.get("title"),
+        "description": clean_html(row.get("body_html", "")),
+        "image_url": extract_first_image(row.get("images", [])),
+        "category": row.get("product_type"),
+        "vendor": vendor,
+        "product_url": f"{store_url}/products/{row.get('handle')}",
+
+        #"vendor": row.get("vendor"),
+        # Kept so reclassify.py can re-run map_categories on cleaned output
+        "tags": row.get("tags"),
+    }
+
+    # Category depends only on the product, not the variant
+    primary_category, subcategory = map_categories(row.get("title", ""), row.get("product_type", ""), row.get("tags", []))
+
+    profile = vendor_profile(vendor)
+    mapped_variants = smart_map_variants(variants, row.get("title", ""), row.get("options"), profile, vendor)
+    for variant, mapped in zip(variants, mapped_variants):
+        print("🧠 Mapped variant fields:", json.dumps(mapped, indent=2))
+        record_vendor_variant(vendor, mapped, profile)
+
+
+        try:
+            price = float(str(variant.get("price", "")).replace("$", "").strip())
+        except:
+            price = None
+
+        flat_row = {
+            "product_id": row.get("id"),
+            "variant_id": variant.get("id"),
+            **common_data,
+            "variant_title": variant.get("title"),
+            "price": price,
+            "available": variant.get("available"),
+            "size": mapped["size"],
+            "color": mapped["color"],
+            "length": mapped["length"],
+            "inseam": mapped.get("inseam"),
+            "product_url": row.get("product_url"), 
+            "primary_category": primary_category,
+            "subcategory": subcategory,
+            **size_columns(mapped, primary_category),
         }
 
-        for variant in variants:
-            mapped = smart_map_variant(variant, row.get("title", ""))
-            print("🧠 Mapped variant fields:", json.dumps(mapped, indent=2))
-            primary_category, subcategory = map_categories(row.get("title", ""), row.get("product_type", ""), row.get("tags", []))
+        yield {col: flat_row.get(col) for col in OUTPUT_COLUMNS}
 
 
+def _flatten_worker(conn, rules):
+    # Spawned workers import the packaged rules; use the parent's instead
+    install_rules(rules)
+    _html_cache_state["added"] = []
+    caches = (_variant_cache, _html_cache)
+    while True:
+        job = conn.recv()
+        if job is None:
+            break
+        first_line, lines = job
+        stats = {}
+        before = [(cache.hits, cache.misses, cache.evictions) for cache in caches]
+        try:
+            rows = [flat_row for row in iter_raw_products(lines, stats, first_line) for flat_row in flatten_product(row)]
+        except Exception as e:
+            conn.send((stats, None, None, None, None, None, repr(e)))
+            continue
+        after = [(cache.hits, cache.misses, cache.evictions) for cache in caches]
+        cache_counts = [[b - a for a, b in zip(*pair)] for pair in zip(before, after)]
+        conn.send((
+            stats, rows, cache_counts, drain_html_cache_entries(),
+            drain_vendor_observations(), drain_option_telemetry(), None,
+        ))
+    conn.close()
+
+
+def _line_batches(lines):
+    batch, batch_bytes, first_line = [], 0, 1
+    for line_no, line in enumerate(lines, 1):
+        if not batch:
+            first_line = line_no
+        batch.append(line)
+        batch_bytes += len(line)
+        if batch_bytes >= PARALLEL_BATCH_BYTES:
+            yield first_line, batch
+            batch, batch_bytes = [], 0
+    if batch:
+        yield first_line, batch
+
+
+def _merge_stats(stats, other):
+    for name, value in other.items():
+        stats[name] = stats.get(name, 0) + value
+
+
+def _flatten_lines_parallel(lines, stats, processes):
+    # spawn, not fork: the handler is multi-threaded (record pool, s3transfer)
+    # and a forked child could inherit a lock held by another thread
+    ctx = multiprocessing.get_context("spawn")
+    workers = []
+    try:
+        for _ in range(processes):
+            parent_conn, child_conn = ctx.Pipe()
+            proc = ctx.Process(target=_flatten_worker, args=(child_conn, current_rules()), daemon=True)
+            proc.start()
+            child_conn.close()
+            workers.append((proc, parent_conn))
+
+        # One batch in flight per worker, so a worker is always waiting in
+        # recv() when we send to it and pipes can't deadlock
+        batches = _line_batches(lines)
+        in_flight = 0
+        for _, conn in workers:
+            batch = next(batches, None)
+            if batch is None:
+                break
+            conn.send(batch)
+            in_flight += 1
+
+        turn = 0
+        while in_flight:
+            conn = workers[turn % len(workers)][1]
+            batch_stats, rows, cache_counts, html_entries, observations, telemetry, error = conn.recv()
+            in_flight -= 1
+            if error:
+                raise RuntimeError(f"Flatten worker failed: {error}")
+            _merge_stats(stats, batch_stats)
+            variant_counts, html_counts = cache_counts
+            _variant_cache.add_counts(*variant_counts)
+            _html_cache.add_counts(*html_counts)
+            merge_html_cache_entries(html_entries)
+            merge_vendor_observations(observations)
+            merge_option_telemetry(telemetry)
+            batch = next(batches, None)
+            if batch is not None:
+                conn.send(batch)
+                in_flight += 1
+            turn += 1
+            yield from rows
+    finally:
+        for proc, conn in workers:
             try:
-                price = float(str(variant.get("price", "")).replace("$", "").strip())
-            except:
-                price = None
-
-            flat_row = {
-                "product_id": row.get("id"),
-                "variant_id": variant.get("id"),
-                **common_data,
-                "variant_title": variant.get("title"),
-                "price": price,
-                "available": variant.get("available"),
-                "size": mapped["size"],
-                "color": mapped["color"],
-                "length": mapped["length"],
-                "inseam": mapped.get("inseam"),
-                "product_url": row.get("product_url"), 
-                "primary_category": primary_category,
-                "subcategory": subcategory,
-            }
-
-            ordered_row = {col: flat_row.get(col) for col in OUTPUT_COLUMNS}
-            flattened.append(ordered_row)
+                conn.send(None)
+            except OSError:
+                pass
+            conn.close()
+        for proc, _ in workers:
+            proc.join(timeout=5)
+            if proc.is_alive():
+                proc.terminate()
 
-    output_key = key.replace(INPUT_PREFIX, OUTPUT_PREFIX).replace(".json", ".json")
-    s3.put_object(
-        Bucket=BUCKET_NAME,
-        Key=output_key,
-        Body=json.dumps(flattened, indent=2).encode("utf-8"),
-        ContentType="application/json"
-    )
 
-    print(f"✅ Uploaded flattened data to: {output_key}")
+# Only one file at a time fans out over the cores; concurrent records flatten serially
+_parallel_lock = threading.Lock()
+
+
+def flatten_lines(lines, stats, size=None):
+    processes = PARALLEL_PROCESSES if size is not None and size >= PARALLEL_MIN_BYTES else 1
+    if processes > 1 and _parallel_lock.acquire(blocking=False):
+        try:
+            yield from _flatten_lines_parallel(lines, stats, processes)
+        finally:
+            _parallel_lock.release()
+        return
+    for row in iter_raw_products(lines, stats):
+        yield from flatten_product(row)
+
+
+_transfer_manager = None
+
+
+def get_transfer_manager():
+    global _transfer_manager
+    if _transfer_manager is None:
+        _transfer_manager = TransferManager(s3, TransferConfig(
+            multipart_threshold=UPLOAD_PART_SIZE,
+            multipart_chunksize=UPLOAD_PART_SIZE,
+            max_request_concurrency=UPLOAD_CONCURRENCY,
+            max_submission_concurrency=MAX_WORKERS + 1,
+            max_in_memory_upload_chunks=UPLOAD_CONCURRENCY,
+        ))
+    return _transfer_manager
+
+
+_lambda_client = None
+
+
+def get_lambda_client():
+    global _lambda_client
+    if _lambda_client is None:
+        # Shards run synchronously for up to the Lambda timeout; never retry an
+        # invoke that may already be running
+        _lambda_client = boto3.client("lambda", config=Config(
+            read_timeout=900, connect_timeout=10, retries={"total_max_attempts": 1}
+        ))
+    return _lambda_client
+
+
+class UploadAborted(Exception):
+    pass
+
+
+class QueueReader(io.RawIOBase):
+    # Non-seekable file object fed by OutputWriter. s3transfer reads it from its
+    # own threads, so parts upload while the handler keeps producing rows.
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._pending = b""
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        # s3transfer expects full parts, so block until `size` bytes or EOF
+        parts = [self._pending]
+        have = len(self._pending)
+        while not self._eof and (size is None or size < 0 or have < size):
+            chunk = self._chunks.get()
+            if chunk is None:
+                self._eof = True
+            elif chunk is UploadAborted:
+                raise UploadAborted("output writer aborted")
+            else:
+                parts.append(chunk)
+                have += len(chunk)
+        data = b"".join(parts)
+        if size is None or size < 0:
+            self._pending = b""
+            return data
+        self._pending = data[size:]
+        return data[:size]
+
+
+class OutputWriter:
+    # Streams compact JSON rows to S3 through a multipart upload.
+
+    def __init__(self, bucket, key, output_format=None, compression=None):
+        self.bucket = bucket
+        self.key = key
+        self.output_format = output_format or OUTPUT_FORMAT
+        if self.output_format not in ("json", "ndjson"):
+            raise ValueError(f"Unsupported OUTPUT_FORMAT: {self.output_format}")
+        self.compression = compression or OUTPUT_COMPRESSION
+        self.row_count = 0
+        self._buffer = bytearray()
+        self._compressor = _compressor(self.compression)
+        self._chunks = queue.Queue(maxsize=UPLOAD_QUEUE_DEPTH)
+        extra_args = {
+            "ContentType": "application/json" if self.output_format == "json" else "application/x-ndjson"
+        }
+        if self._compressor is not None:
+            extra_args["ContentEncoding"] = self.compression
+        self._future = get_transfer_manager().upload(
+            QueueReader(self._chunks), bucket, key, extra_args=extra_args
+        )
+
+    def write(self, row):
+        line = json.dumps(row, separators=(",", ":")).encode("utf-8")
+        if self.output_format == "ndjson":
+            self._buffer += line + b"\n"
+        else:
+            self._buffer += (b"[" if self.row_count == 0 else b",") + line
+        self.row_count += 1
+        if len(self._buffer) >= UPLOAD_QUEUE_CHUNK_SIZE:
+            self._flush()
+
+    def _flush(self, final=False):
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+            if final:
+                data += self._compressor.flush()
+        if data:
+            self._put(data)
+
+    def _put(self, chunk):
+        # Don't block forever if the upload has already failed
+        while True:
+            try:
+                self._chunks.put(chunk, timeout=1)
+                return
+            except queue.Full:
+                if self._future.done():
+                    self._future.result()
+                    raise UploadAborted(f"upload to {self.key} stopped reading")
+
+    def close(self):
+        if self.output_format == "json":
+            self._buffer += b"]" if self.row_count else b"[]"
+        self._flush(final=True)
+        self._put(None)
+        self._future.result()
+
+    def abort(self):
+        # Raising inside the reader makes s3transfer abort the multipart upload
+        # instead of completing it with partial output
+        while True:
+            try:
+                self._chunks.get_nowait()
+            except queue.Empty:
+                break
+        self._chunks.put(UploadAborted)
+        try:
+            self._future.result()
+        except Exception:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def iter_s3_records(event):
+    # S3 notifications arrive either directly or wrapped in SQS message bodies.
+    # Yields (sqs message id or None, s3 record).
+    for record in event.get("Records", []):
+        if record.get("eventSource") == "aws:sqs":
+            body = json.loads(record["body"])
+            for s3_record in body.get("Records", []):
+                yield record["messageId"], s3_record
+        else:
+            yield None, record
+
+
+class NotReady(Exception):
+    pass
+
+
+def _normalize_etag(etag):
+    return (etag or "").strip('"')
+
+
+def process_key(key, size=None, etag=None, expected_products=None):
+    print(f"Lambda triggered for key: {key}")
+
+    if size is not None and size >= SHARD_THRESHOLD_BYTES and SHARD_FUNCTION_NAME:
+        result = process_sharded(key, etag, expected_products)
+        if result is not None:
+            return result
+
+    # Pin the read to the object version we were told about instead of
+    # sleeping and hoping the upload has settled
+    extra = {"IfMatch": f'"{_normalize_etag(etag)}"'} if etag else {}
+    try:
+        obj = s3.get_object(Bucket=BUCKET_NAME, Key=key, **extra)
+    except s3.exceptions.NoSuchKey:
+        print(f"❌ No such key in bucket: {key}")
+        raise
+    if size is not None and obj["ContentLength"] != size:
+        raise NotReady(f"{key} is {obj['ContentLength']} bytes, expected {size}")
+
+    compression = detect_compression(key, obj.get("ContentEncoding"))
+    lines = iter_lines(decompress_chunks(obj["Body"].iter_chunks(READ_CHUNK_SIZE), compression))
+
+    output_key = output_key_for(key)
+    stats = {"products": 0}
+    with OutputWriter(BUCKET_NAME, output_key) as writer:
+        for flat_row in flatten_lines(lines, stats, obj["ContentLength"]):
+            writer.write(flat_row)
+        # Raising here aborts the upload, so a short file never reaches cleaned-shopify/
+        _check_products(key, stats["products"], expected_products)
+
+    print(f"✅ Uploaded {writer.row_count} flattened rows to: {output_key}")
+    return {"key": key, "output_key": output_key, "rows": writer.row_count, **stats}
+
+
+def _check_products(key, products, expected):
+    if expected is not None and products != expected:
+        raise NotReady(f"{key} parsed {products} products, manifest lists {expected}")
+
+
+def find_line_start(key, offset, etag, size):
+    # First byte of the first line that starts at or after `offset`, or None
+    # if the last line runs to EOF. S3 rejects ranges starting past the end
+    # (416 InvalidRange), so probes stop at `size`.
+    position = offset - 1
+    while position < size:
+        obj = s3.get_object(
+            Bucket=BUCKET_NAME, Key=key, IfMatch=etag,
+            Range=f"bytes={position}-{min(position + SHARD_PROBE_BYTES, size) - 1}",
+        )
+        probe = obj["Body"].read()
+        if not probe:
+            return None
+        newline = probe.find(b"\n")
+        if newline != -1:
+            return position + newline + 1
+        position += len(probe)
+    return None
+
+
+def shard_ranges(key, size, etag):
+    starts = [0]
+    offset = SHARD_SIZE_BYTES
+    while offset < size:
+        start = find_line_start(key, offset, etag, size)
+        if start is None or start >= size:
+            break
+        starts.append(start)
+        offset = start + SHARD_SIZE_BYTES
+    return list(zip(starts, starts[1:] + [size]))
+
+
+def process_sharded(key, etag=None, expected_products=None):
+    head = s3.head_object(Bucket=BUCKET_NAME, Key=key, **({"IfMatch": f'"{_normalize_etag(etag)}"'} if etag else {}))
+    if detect_compression(key, head.get("ContentEncoding")):
+        # Compressed streams can't be split by byte range
+        return None
+    etag = head["ETag"]
+    ranges = shard_ranges(key, head["ContentLength"], etag)
+    if len(ranges) < 2:
+        return None
+
+    output_key = output_key_for(key)
+    shards = [
+        {
+            "key": key,
+            "etag": etag,
+            "start": start,
+            "end": end,
+            "part_key": f"{SHARD_PREFIX}/{output_key}/part-{i:05d}.ndjson",
+            "rules": current_rules().digest,
+        }
+        for i, (start, end) in enumerate(ranges)
+    ]
+    print(f"🔀 Splitting {key} ({head['ContentLength']} bytes) into {len(shards)} shards")
+
+    try:
+        with ThreadPoolExecutor(max_workers=min(SHARD_CONCURRENCY, len(shards))) as pool:
+            parts = list(pool.map(invoke_shard, shards))
+        _check_products(key, sum(part["products"] for part in parts), expected_products)
+
+        # Re-emit the shard rows in order so the output matches a serial run
+        with OutputWriter(BUCKET_NAME, output_key) as writer:
+            for shard in shards:
+                obj = s3.get_object(Bucket=BUCKET_NAME, Key=shard["part_key"])
+                for line in iter_lines(obj["Body"].iter_chunks(READ_CHUNK_SIZE)):
+                    if line:
+                        writer.write(json.loads(line))
+    finally:
+        s3.delete_objects(Bucket=BUCKET_NAME, Delete={
+            "Objects": [{"Key": shard["part_key"]} for shard in shards], "Quiet": True
+        })
+
+    print(f"✅ Uploaded {writer.row_count} flattened rows to: {output_key}")
     return {
-        "statusCode": 200,
-        "body": f"Flattened JSON written to {output_key}"
+        "key": key,
+        "output_key": output_key,
+        "products": sum(part["products"] for part in parts),
+        "rows": writer.row_count,
+        "shards": len(shards),
     }
 
 
+def invoke_shard(shard):
+    response = get_lambda_client().invoke(
+        FunctionName=SHARD_FUNCTION_NAME,
+        InvocationType="RequestResponse",
+        Payload=json.dumps({"shard": shard}).encode("utf-8"),
+    )
+    payload = json.loads(response["Payload"].read() or b"null")
+    if response.get("FunctionError"):
+        raise RuntimeError(f"Shard {shard['part_key']} failed: {payload}")
+    return payload
+
+
+def process_shard(shard):
+    obj = s3.get_object(
+        Bucket=BUCKET_NAME, Key=shard["key"], IfMatch=shard["etag"],
+        Range=f"bytes={shard['start']}-{shard['end'] - 1}",
+    )
+    lines = iter_lines(obj["Body"].iter_chunks(READ_CHUNK_SIZE))
+
+    stats = {"products": 0}
+    with OutputWriter(BUCKET_NAME, shard["part_key"], output_format="ndjson", compression="none") as writer:
+        for flat_row in flatten_lines(lines, stats, obj["ContentLength"]):
+            writer.write(flat_row)
+
+    print(f"✅ Shard {shard['start']}-{shard['end']} of {shard['key']}: {writer.row_count} rows")
+    return {"part_key": shard["part_key"], "rows": writer.row_count, **stats}
+
+
+def process_manifest_entry(entry):
+    key = entry["key"]
+    try:
+        result = process_key(key, entry.get("size"), entry.get("etag"), entry.get("rows"))
+        result["status"] = "ok"
+    except Exception as e:
+        print(f"❌ Failed to flatten {key}: {e}")
+        result = {"key": key, "status": "error", "error": str(e)}
+    return result
+
+
+def process_manifest(key):
+    print(f"📋 Manifest received: {key}")
+    manifest = json.loads(s3.get_object(Bucket=BUCKET_NAME, Key=key)["Body"].read())
+    entries = manifest.get("files", [])
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_WORKERS, len(entries)))) as pool:
+        files = list(pool.map(process_manifest_entry, entries))
+
+    failed = [f for f in files if f["status"] != "ok"]
+    result = {
+        "key": key,
+        "status": "error" if failed else "ok",
+        "rows": sum(f.get("rows", 0) for f in files),
+        "files": files,
+    }
+    if failed:
+        result["error"] = f"{len(failed)} of {len(files)} manifest files failed"
+    return result
 
+
+def process_record(message_id, record):
+    s3_object = record["s3"]["object"]
+    key = unquote_plus(s3_object["key"])
+    try:
+        if key.endswith(MANIFEST_SUFFIX):
+            if READINESS_MODE == "manifest":
+                result = process_manifest(key)
+            else:
+                # The files it lists were already flattened as their own events
+                print(f"⏭️ Skipping manifest {key}; READINESS_MODE is {READINESS_MODE}")
+                result = {"key": key, "status": "skipped"}
+        elif READINESS_MODE == "manifest":
+            print(f"⏭️ Skipping {key}; waiting for its manifest")
+            result = {"key": key, "status": "skipped"}
+        else:
+            result = process_key(key, s3_object.get("size"), s3_object.get("eTag"))
+            result["status"] = "ok"
+    except Exception as e:
+        print(f"❌ Failed to flatten {key}: {e}")
+        result = {"key": key, "status": "error", "error": str(e)}
+    result["message_id"] = message_id
+    return result
+
+
+def lambda_handler(event, context):
+    refresh_rules()
+
+    # Byte-range worker invoked by process_sharded
+    if "shard" in event:
+        # Flatten with the same rules as the other shards of the file
+        if event["shard"].get("rules", current_rules().digest) != current_rules().digest:
+            refresh_rules(force=True)
+        result = process_shard(event["shard"])
+        save_html_cache()
+        update_vendor_profiles()
+        write_option_report(getattr(context, "aws_request_id", None))
+        return result
+
+    records = list(iter_s3_records(event))
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_WORKERS, len(records)))) as pool:
+        results = list(pool.map(lambda r: process_record(*r), records))
+
+    failed = [r for r in results if r["status"] == "error"]
+    print(f"✅ Flattened {len(results) - len(failed)}/{len(results)} files")
+    save_html_cache()
+    print(f"🗄️ clean_html cache: {_html_cache.stats()}")
+    print(f"🧠 smart_map_variant cache: {_variant_cache.stats()}")
+    flagged_vendors = update_vendor_profiles()
+    option_report_key = write_option_report(getattr(context, "aws_request_id", None))
+
+    # A direct S3 invocation has no per-item retry, so fail it and let Lambda retry
+    if failed and any(r["message_id"] is None for r in failed):
+        raise RuntimeError(f"Failed to flatten: {', '.join(r['key'] for r in failed)}")
+
+    return {
+        "statusCode": 200 if not failed else 207,
+        "body": f"Flattened {len(results) - len(failed)} of {len(results)} files",
+        "results": results,
+        "html_cache": _html_cache.stats(),
+        "variant_cache": _variant_cache.stats(),
+        "flagged_vendors": flagged_vendors,
+        "option_report": option_report_key,
+        # Partial batch response for SQS triggers (ReportBatchItemFailures)
+        "batchItemFailures": [
+            {"itemIdentifier": mid} for mid in dict.fromkeys(r["message_id"] for r in failed)
+        ],
+    }
@@ -0,0 +1,172 @@
+# Re-apply the current category rules (and optionally the variant mapping) to
+# existing cleaned-shopify/ outputs without re-flattening raw data, e.g.
+# after editing the category rule file:
+#
+#   python reclassify.py --prefix cleaned-shopify/2025-05 --processes 8
+#
+# Only rows whose result changed are written, as NDJSON deltas under
+# cleaned-shopify/_deltas/<run>/. Each line is {"match": {column: value},
+# "set": {column: value}}; the upload lambda applies them as PATCHes.
+# Category changes are one line per product, variant changes one per variant.
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+import lambda_function as lf
+
+
+DELTA_PREFIX = f"{lf.OUTPUT_PREFIX}/_deltas"
+DELTA_SUFFIX = ".delta.ndjson"
+VARIANT_COLUMNS = ("size", "color", "length", "inseam", "waist_in", "inseam_in", "alpha_size_rank", "shoe_size", "width", "fit_class")
+
+
+def list_cleaned_objects(bucket, prefix):
+    paginator = lf.s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            key = obj["Key"]
+            if key.endswith("/") or key.startswith(DELTA_PREFIX + "/"):
+                continue
+            yield {"key": key, "size": obj["Size"]}
+
+
+def iter_cleaned_rows(bucket, key):
+    # OutputWriter writes either a JSON array (loaded whole) or NDJSON (streamed)
+    obj = lf.s3.get_object(Bucket=bucket, Key=key)
+    compression = lf.detect_compression(key, obj.get("ContentEncoding"))
+    chunks = lf.decompress_chunks(obj["Body"].iter_chunks(lf.READ_CHUNK_SIZE), compression)
+    lines = lf.iter_lines(chunks)
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith(b"["):
+            yield from json.loads(b"".join([line, *lines]))
+            return
+        yield json.loads(line)
+
+
+def _products(rows):
+    # Rows of one product are contiguous in flatten output
+    products = {}
+    for row in rows:
+        products.setdefault(str(row.get("product_id")), []).append(row)
+    return products.items()
+
+
+def product_deltas(product_id, rows, variants=False):
+    first = rows[0]
+    # Outputs written before "tags" was a column are classified without tags;
+    # if that finds nothing, the old category may have come from the tags, so
+    # it is kept rather than downgraded to Other
+    primary, sub = lf.map_categories(first.get("product_title") or "", first.get("category") or "", first.get("tags"))
+    untagged_other = "tags" not in first and primary == "Other"
+    if not untagged_other and (primary, sub) != (first.get("primary_category"), first.get("subcategory")):
+        yield {"match": {"product_id": product_id}, "set": {"primary_category": primary, "subcategory": sub}}
+    if not variants:
+        return
+
+    # Cleaned rows don't keep option1-3 or the option names, but Shopify's
+    # variant title is the option values joined with " / ". Without the names
+    # a value can land in the wrong field ("32 / 34" under Waist/Inseam reads
+    # as size 34), so a remap only fills columns that are still empty; it
+    # never changes or clears one the flatten stage set.
+    raw_variants = []
+    for row in rows:
+        values = (row.get("variant_title") or "").split(" / ")[:3]
+        raw_variants.append({
+            "title": row.get("variant_title") or "",
+            **{f"option{i}": value for i, value in enumerate(values, 1)},
+        })
+    mapped_variants = lf.smart_map_variants(raw_variants, first.get("product_title") or "")
+    for row, mapped in zip(rows, mapped_variants):
+        remapped = {
+            "size": mapped["size"], "color": mapped["color"], "length": mapped["length"], "inseam": mapped["inseam"],
+            **lf.size_columns(mapped, primary),
+        }
+        changed = {
+            column: remapped[column] for column in VARIANT_COLUMNS
+            if remapped[column] is not None and row.get(column) is None
+        }
+        if changed:
+            yield {"match": {"variant_id": str(row.get("variant_id"))}, "set": changed}
+
+
+def reclassify_object(bucket, obj, variants=False):
+    try:
+        rows = 0
+        deltas = []
+        for product_id, product_rows in _products(iter_cleaned_rows(bucket, obj["key"])):
+            rows += len(product_rows)
+            deltas.extend(product_deltas(product_id, product_rows, variants))
+    except Exception as e:
+        return {"key": obj["key"], "status": "error", "error": str(e)}
+    return {"key": obj["key"], "status": "ok", "rows": rows, "deltas": deltas}
+
+
+def delta_key(run_id, key):
+    relative = key[len(lf.OUTPUT_PREFIX) + 1:] if key.startswith(lf.OUTPUT_PREFIX + "/") else key
+    for extensions in (lf.COMPRESSION_EXTENSIONS.values(), (".ndjson", ".json")):
+        relative = next((relative[:-len(ext)] for ext in extensions if relative.endswith(ext)), relative)
+    return f"{DELTA_PREFIX}/{run_id}/{relative}{DELTA_SUFFIX}"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write category (and variant) deltas for cleaned-shopify/")
+    parser.add_argument("--bucket", default=lf.BUCKET_NAME)
+    parser.add_argument("--prefix", default=lf.OUTPUT_PREFIX + "/")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--variants", action="store_true",
+                        help="also re-map size/color/length/inseam from the variant titles")
+    parser.add_argument("--dry-run", action="store_true", help="count the changes without writing deltas")
+    args = parser.parse_args(argv)
+
+    objects = list(list_cleaned_objects(args.bucket, args.prefix))
+    rules = lf.refresh_rules(force=True)
+    print(f"🔎 Reclassifying {len(objects)} cleaned files under s3://{args.bucket}/{args.prefix} "
+          f"with rules {rules.digest[:12]}")
+
+    run_id = f"{datetime.now(timezone.utc):%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}"
+    seen = set()
+    results = []
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(
+        max_workers=max(1, args.processes), mp_context=ctx, initializer=lf.install_rules, initargs=(rules,),
+    ) as pool:
+        futures = [pool.submit(reclassify_object, args.bucket, obj, args.variants) for obj in objects]
+        for future in futures:
+            result = future.result()
+            results.append(result)
+            if result["status"] != "ok":
+                print(f"❌ {result['key']}: {result['error']}")
+                continue
+            # The same product often appears in several outputs; write each change once
+            deltas = []
+            for delta in result.pop("deltas"):
+                fingerprint = json.dumps(delta, sort_keys=True)
+                if fingerprint not in seen:
+                    seen.add(fingerprint)
+                    deltas.append(delta)
+            result["changes"] = len(deltas)
+            if deltas and not args.dry_run:
+                result["delta_key"] = delta_key(run_id, result["key"])
+                with lf.OutputWriter(args.bucket, result["delta_key"], output_format="ndjson", compression="none") as writer:
+                    for delta in deltas:
+                        writer.write(delta)
+            print(f"{'✏️' if deltas else '✅'} {result['key']}: {result['changes']} changes in {result['rows']} rows"
+                  + (f" -> {result['delta_key']}" if "delta_key" in result else ""))
+
+    failed = [r for r in results if r["status"] != "ok"]
+    print(f"🏁 {sum(r.get('changes', 0) for r in results)} changes across "
+          f"{sum(1 for r in results if r.get('changes'))}/{len(results)} files"
+          + (" (dry run, nothing written)" if args.dry_run else f" under {DELTA_PREFIX}/{run_id}/"))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
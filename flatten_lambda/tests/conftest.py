@@ -0,0 +1,5 @@
+import os
+import sys
+
+# lambda_function is deployed as a top-level module from flatten_lambda/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
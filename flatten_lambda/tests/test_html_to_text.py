@@ -0,0 +1,32 @@
+import pytest
+from bs4 import BeautifulSoup
+
+import lambda_function as lf
+
+
+# html_to_text skips BeautifulSoup where it can, but must give the same text
+@pytest.mark.parametrize("html", [
+    "plain text",
+    "  padded  ",
+    "a < b",
+    "<p>Soft &amp; stretchy</p>",
+    "<p>One</p><p>Two</p>",
+    "a<br>b",
+    "<ul><li>Cotton</li><li>Elastane</li></ul>",
+    "<p>Fits <strong>true</strong> to size.</p>\n<p>Machine wash.</p>",
+    "<div><span>A</span> <span>B</span></div>",
+    "<table><tr><td>1</td><td>2</td></tr></table>",
+    "<p>x<!-- hidden -->y</p>",
+    "<p>unclosed",
+    "Tom&nbsp;&amp;&nbsp;Jerry",
+    "5 &lt; 6 &gt; 4",
+    "&#8217;quoted&#8217; &#x2014; dash",
+    "&#150; cp1252",
+    "caf&eacute; &copy; &notanentity;",
+    "&amp",
+    "<script>var x=1;</script>after",
+    "<style>p{}</style>text",
+    "<!DOCTYPE html><p>doc</p>",
+])
+def test_matches_beautifulsoup(html):
+    assert lf.html_to_text(html) == BeautifulSoup(html, "html.parser").get_text(separator=" ").strip()
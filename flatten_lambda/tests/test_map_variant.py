@@ -0,0 +1,59 @@
+import pytest
+
+import lambda_function as lf
+
+
+def mapped(names, values, product_title="Tall Jeans"):
+    variant = {f"option{i}": value for i, value in enumerate(values, 1)}
+    variant["title"] = " / ".join(values)
+    return lf.smart_map_variant(variant, product_title, [{"name": name} for name in names])
+
+
+@pytest.mark.parametrize("names, values, size, inseam, waist_in", [
+    (["Waist", "Inseam"], ["34", "32"], "34", 32, 34),
+    (["Waist", "Length"], ["32", "30"], "32", 30, 32),
+    (["Waist", "Length"], ["32W", "36L"], "32w", 36, 32),
+    (["Size", "Inseam"], ["L", "34"], "l", 34, None),
+    (["Size", "Inseam"], ["32", "34 x 36"], "32", 36, 32),
+    (["Inseam"], ["34L"], None, 34, None),
+])
+def test_numeric_inseams_are_not_read_as_sizes(names, values, size, inseam, waist_in):
+    result = mapped(names, values)
+    assert result["size"] == size
+    assert result["inseam"] == inseam
+    assert lf.size_columns(result, "Bottoms")["waist_in"] == waist_in
+
+
+def test_length_terms_stay_lengths():
+    result = mapped(["Waist", "Length"], ["32", "Regular"])
+    assert (result["size"], result["length"], result["inseam"]) == ("32", "regular", None)
+    assert lf.size_columns(result, "Bottoms")["waist_in"] == 32
+
+
+def test_scan_does_not_replace_a_named_field():
+    result = mapped(["Size", "Color"], ["M", "Black"])
+    assert (result["size"], result["color"]) == ("m", "black")
+    assert result["option_routes"] == ("size", "color", None)
+
+
+@pytest.mark.parametrize("names, values, expected", [
+    (["Color", "Size"], ["Navy", "X-Large"], ("x-large", "navy", None, ("color", "size", None))),
+    (["Colour", "Waist", "Length"], ["Olive", "34", "Long"], ("34", "olive", "long", ("color", "size", "length"))),
+    # Unnamed options fall back to the lexicon scan
+    (["Option1", "Option2"], ["36", "Grey"], ("36", "grey", None, ("size", "color", None))),
+])
+def test_options_are_routed_by_name_in_any_order(names, values, expected):
+    result = mapped(names, values)
+    assert (result["size"], result["color"], result["length"], result["option_routes"]) == expected
+
+
+@pytest.mark.parametrize("category, waist_in",[("Outerwear", None), ("Tops", None), ("Bottoms", 42)])
+def test_suit_sizes_are_only_waists_for_bottoms(category, waist_in):
+    result = mapped(["Size"], ["42L"], "Wool Blazer")
+    assert lf.size_columns(result, category)["waist_in"] == waist_in
+
+
+def test_value_claimed_by_a_named_field_is_not_trusted_by_name():
+    result = mapped(["Size", "Inseam", "Color"], ["XL", "", "32"])
+    assert (result["size"], result["color"]) == ("xl", None)
+    assert result["option_issues"][2] == ("unmapped", ())
@@ -0,0 +1,71 @@
+import pytest
+
+import lambda_function as lf
+
+
+# Every literal the old alpha_sizes set listed still parses, with the fit split off
+@pytest.mark.parametrize("text, label, fit", [
+    *((size, size, None) for size in (
+        "xxxs", "xxs", "xs", "s", "m", "l", "xl", "xxl", "xxxl", "xxxxl", "xxxxxl",
+        "2xs", "3xs", "4xs", "5xs", "1xl", "2xl", "3xl", "4xl", "5xl", "6xl", "7xl", "8xl",
+        "0x", "1x", "2x", "3x", "4x", "5x", "6x", "7x", "8x", "9x",
+    )),
+    ("slt", "s", "tall"), ("mt", "m", "tall"), ("lt", "l", "tall"), ("xlt", "xl", "tall"),
+    ("1xlt", "1xl", "tall"), ("8xlt", "8xl", "tall"), ("xt", None, "extra tall"),
+    ("mxt", "m", "extra tall"), ("lxt", "l", "extra tall"), ("xlxt", "xl", "extra tall"),
+    ("1xlxt", "1xl", "extra tall"), ("8xlxt", "8xl", "extra tall"),
+    ("1xb", "1x", "big"), ("9xb", "9x", "big"), ("1xt", "1x", "tall"), ("8xt", "8x", "tall"),
+    ("lmt", "l", "tall"), ("xlmt", "xl", "tall"), ("2xmt", "2x", "tall"), ("5xmt", "5x", "tall"),
+    ("XXS/XS", "xxs/xs", None), ("S/M", "s/m", None), ("1x/2x", "1x/2x", None),
+    ("X-Large", "xl", None), ("extra small", "xs", None), ("2X-Large", "2xl", None), ("Medium", "m", None),
+])
+def test_alpha_sizes(text, label, fit):
+    assert lf.parse_size(text) == lf.SizeSpec("alpha", label, None, None, None, fit)
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("000", ("numeric", "000", None, None, None, None)),
+    ("00", ("numeric", "00", None, None, None, None)),
+    ("7.5", ("numeric", "7.5", None, None, None, None)),
+    ("8 1/2", ("numeric", "8.5", None, None, None, None)),
+    ("Size 32", ("numeric", "32", None, None, None, None)),
+    ("Size 32 /", ("numeric", "32", None, None, None, None)),
+    ("10 W", ("us_shoe", "10", None, None, "w", None)),
+    ("10 wide", ("us_shoe", "10", None, None, "w", None)),
+    ("10 3E", ("us_shoe", "10", None, None, "3e", None)),
+    ("EU 42", ("eu", "42", None, None, None, None)),
+    ("UK 9", ("uk", "9", None, None, None, None)),
+    ("32x34", ("waist", "32x34", 32, 34, None, None)),
+    ("32 X 34", ("waist", "32x34", 32, 34, None, None)),
+    ("32W x 34L", ("waist", "32x34", 32, 34, None, None)),
+    ("32 x 34 length", ("waist", "32x34", 32, 34, None, None)),
+    ("34R", ("waist", "34", 34, None, None, "regular")),
+    ("36 Tall", ("waist", "36", 36, None, None, "tall")),
+    ("15.5x34", ("neck", "15.5x34", None, None, None, None)),
+])
+def test_other_size_systems(text, expected):
+    assert lf.parse_size(text) == lf.SizeSpec(*expected)
+
+
+@pytest.mark.parametrize("text", ["inseam 34", "red", "one size", "100"])
+def test_not_sizes(text):
+    assert lf.parse_size(text) is None
+
+
+@pytest.mark.parametrize("text, inches", [
+    ('34"', 34), ("34''", 34), ("34 in", 34), ("34 inch", 34), ('34.5"', 34.5), ('34 1/2"', 34.5),
+    ("86 cm", 33.75), ("inseam: 34", 34), ("inseam 34", 34), ("34 inseam", 34),
+    ("l34", 34), ("w32 l34", 34), ("32x34", 34), ("32 x 34 l", 34),
+    ("34l inseam", 34), ("34l length", 34), ('30" 32" inseam', 32),
+    # A bare 34L is a waist or blazer fit; out-of-range numbers aren't inseams
+    ("42l", None), ('10"', None), ("60 inseam", None), ("size 34", None),
+])
+def test_extract_inseam(text, inches):
+    assert lf.extract_inseam([("option1", text)]) == ((inches, "option1") if inches else (None, None))
+
+
+def test_extract_inseam_prefers_a_labelled_source():
+    sources = [("option1", "32"), ("variant_title", '32 / 34"'), ("product_title", 'jeans 30" inseam')]
+    assert lf.extract_inseam(sources) == (30, "product_title")
+    assert lf.extract_inseam(sources[:2]) == (34, "variant_title")
+    assert lf.extract_inseam([]) == (None, None)
@@ -0,0 +1,103 @@
+# Merge the per-run option telemetry reports the flatten lambda writes to
+# OPTION_TELEMETRY_PREFIX and list the lexicon gaps that cost the most, e.g.
+#
+#   python unmapped_report.py --since 2026-10-01 --sort seconds --top 30
+#
+# "count" is how many variants carried the value (coverage lost), "seconds"
+# is time spent mapping it on variant-memo misses.
+import argparse
+import json
+import sys
+from collections import Counter
+
+import lambda_function as lf
+
+
+SORT_KEYS = ("count", "seconds", "vendors")
+
+
+def list_reports(bucket, prefix, since=None):
+    paginator = lf.s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            key = obj["Key"]
+            if not key.endswith(".json"):
+                continue
+            # Keys are <prefix>/<YYYY-MM-DD>/<time>-<run>.json
+            day = key[len(prefix):].lstrip("/").split("/", 1)[0]
+            if since and day < since:
+                continue
+            yield key
+
+
+def merge_reports(reports):
+    merged = {"runs": 0, "variants": 0, "values": {}}
+    for report in reports:
+        if report.get("version") != lf.OPTION_TELEMETRY_VERSION:
+            print(f"⚠️ Skipping report with version {report.get('version')}", file=sys.stderr)
+            continue
+        merged["runs"] += 1
+        merged["variants"] += report.get("variants", 0)
+        for value in report.get("values", []):
+            key = (value["issue"], value["value"], tuple(value["candidates"]))
+            entry = merged["values"].setdefault(key, {
+                "issue": value["issue"], "value": value["value"], "candidates": value["candidates"],
+                "count": 0, "seconds": 0.0, "runs": 0, "vendors": Counter(),
+            })
+            entry["count"] += value["count"]
+            entry["seconds"] += value["seconds"]
+            entry["runs"] += 1
+            entry["vendors"].update(value["vendors"])
+    return merged
+
+
+def ranked(merged, sort="count", issue=None):
+    values = [v for v in merged["values"].values() if issue is None or v["issue"] == issue]
+    if sort == "vendors":
+        return sorted(values, key=lambda v: (-len(v["vendors"]), -v["count"], v["value"]))
+    return sorted(values, key=lambda v: (-v[sort], v["value"]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Merge flatten option telemetry reports")
+    parser.add_argument("--bucket", default=lf.BUCKET_NAME)
+    parser.add_argument("--prefix", default=lf.OPTION_TELEMETRY_PREFIX)
+    parser.add_argument("--since", help="first day to include (YYYY-MM-DD)")
+    parser.add_argument("--issue", choices=["unmapped", "name_only", "ambiguous"])
+    parser.add_argument("--sort", choices=SORT_KEYS, default="count")
+    parser.add_argument("--top", type=int, default=50)
+    parser.add_argument("--output", help="also write the merged report as JSON to this path")
+    args = parser.parse_args(argv)
+
+    keys = list(list_reports(args.bucket, args.prefix, args.since))
+    print(f"🔎 Found {len(keys)} reports under s3://{args.bucket}/{args.prefix}")
+    merged = merge_reports(
+        json.loads(lf.s3.get_object(Bucket=args.bucket, Key=key)["Body"].read()) for key in keys
+    )
+    values = ranked(merged, args.sort, args.issue)
+
+    print(f"📊 {merged['runs']} runs, {merged['variants']} variants, {len(values)} problem values")
+    print(f"{'issue':<10} {'count':>8} {'share':>7} {'seconds':>9} {'runs':>5}  value (candidates) — vendors")
+    for v in values[:args.top]:
+        share = v["count"] / merged["variants"] if merged["variants"] else 0
+        candidates = f" ({', '.join(v['candidates'])})" if v["candidates"] else ""
+        vendors = ", ".join(vendor for vendor, _ in v["vendors"].most_common(lf.OPTION_TELEMETRY_MAX_VENDORS))
+        print(f"{v['issue']:<10} {v['count']:>8} {share:>7.2%} {v['seconds']:>9.3f} {v['runs']:>5}  "
+              f"{v['value']!r}{candidates} — {vendors}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "runs": merged["runs"],
+                "variants": merged["variants"],
+                "values": [
+                    {**v, "seconds": round(v["seconds"], 6), "vendors": dict(v["vendors"].most_common())}
+                    for v in values
+                ],
+            }, f, indent=2)
+        print(f"💾 Wrote merged report to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
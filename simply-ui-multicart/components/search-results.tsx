@@ -115,15 +115,14 @@ export function SearchResults({ query, onClearSearch }: SearchResultsProps) {
           supabaseQuery = supabaseQuery.ilike("color", `%${colorMatch}%`)
         }
 
+        // Numeric sizes use the indexed waist_in / shoe_size / inseam_in columns
         if (size) {
-          supabaseQuery = supabaseQuery.or(`size.ilike.%${size}%,size.eq.${size}`)
+          supabaseQuery = supabaseQuery.or(`waist_in.eq.${size},shoe_size.eq.${size},size.eq.${size}`)
         }
 
         // Apply specific measurement filters
         if (inseam) {
-          supabaseQuery = supabaseQuery.or(
-            `inseam.ilike.%${inseam}%,inseam.eq.${inseam},description.ilike.%inseam ${inseam}%,description.ilike.%${inseam} inseam%`,
-          )
+          supabaseQuery = supabaseQuery.eq("inseam_in", inseam)
         }
 
         if (length) {
@@ -0,0 +1,17 @@
+-- Numeric size columns emitted by flatten_lambda alongside the free-text
+-- size / length / inseam fields, so filters can use range scans on B-tree
+-- indexes instead of ilike OR-chains over text.
+ALTER TABLE public.products
+  ADD COLUMN IF NOT EXISTS waist_in NUMERIC(4,1),
+  ADD COLUMN IF NOT EXISTS inseam_in NUMERIC(4,2),
+  ADD COLUMN IF NOT EXISTS alpha_size_rank NUMERIC(3,1),
+  ADD COLUMN IF NOT EXISTS shoe_size NUMERIC(3,1),
+  ADD COLUMN IF NOT EXISTS width TEXT,
+  ADD COLUMN IF NOT EXISTS fit_class TEXT;
+
+-- Waist is usually filtered together with inseam ("32 x 34 and longer")
+CREATE INDEX IF NOT EXISTS products_waist_in_inseam_in_idx ON public.products (waist_in, inseam_in);
+CREATE INDEX IF NOT EXISTS products_inseam_in_idx ON public.products (inseam_in);
+CREATE INDEX IF NOT EXISTS products_alpha_size_rank_idx ON public.products (alpha_size_rank);
+CREATE INDEX IF NOT EXISTS products_shoe_size_width_idx ON public.products (shoe_size, width);
+CREATE INDEX IF NOT EXISTS products_fit_class_idx ON public.products (fit_class);
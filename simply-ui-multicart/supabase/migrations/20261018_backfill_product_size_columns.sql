@@ -0,0 +1,36 @@
+-- Fill the numeric size columns for rows inserted before flatten_lambda
+-- emitted them, so inseam/waist searches on inseam_in / waist_in still find
+-- them. Mirrors size_columns() in flatten_lambda for the unambiguous cases;
+-- rows flattened again later overwrite these values. As there, suit and
+-- blazer sizes (40R, 42L) in Tops/Outerwear and shoe sizes get no waist.
+
+-- Inseam in inches: "34", "32.5"
+UPDATE public.products
+SET inseam_in = inseam::text::numeric
+WHERE inseam_in IS NULL
+  AND inseam::text ~ '^\d{2}(\.\d{1,2})?$'
+  AND inseam::text::numeric BETWEEN 20 AND 50;
+
+-- Waist by inseam in the size: "32x34", "32 x 34", "32W x 34L"
+UPDATE public.products
+SET waist_in = substring(size from '^\s*([2-9]\d)')::numeric,
+    inseam_in = coalesce(inseam_in, substring(size from '[xX]\s*(\d{2})')::numeric)
+WHERE waist_in IS NULL
+  AND size ~ '^\s*[2-9]\d\s*[wW]?\s*[xX]\s*\d{2}\s*[lL]?\s*$'
+  AND coalesce(primary_category, '') NOT IN ('Tops', 'Outerwear', 'Shoes');
+
+-- Waist with a W or a fit: "32W", "34 Regular", "36 Tall"
+UPDATE public.products
+SET waist_in = substring(size from '^\s*([2-9]\d)')::numeric
+WHERE waist_in IS NULL
+  AND size ~* '^\s*[2-9]\d\s*(w|w?[ -]?(regular|reg|short|long|tall|r|l|s|t))\s*$'
+  AND coalesce(primary_category, '') NOT IN ('Tops', 'Outerwear', 'Shoes');
+
+-- A bare waist next to an inseam: size "32" with inseam 34
+UPDATE public.products
+SET waist_in = trim(size)::numeric
+WHERE waist_in IS NULL
+  AND inseam_in IS NOT NULL
+  AND size ~ '^\s*\d{2}\s*$'
+  AND trim(size)::numeric BETWEEN 24 AND 60
+  AND coalesce(primary_category, '') NOT IN ('Tops', 'Outerwear', 'Shoes');
@@ -1,45 +1,96 @@
 import boto3
+import itertools
 import json
 import os
 import requests
 import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
+from urllib.parse import unquote_plus
+
+try:
+    import zstandard
+except ImportError:  # only needed for .zst objects
+    zstandard = None
 
 # ✅ Safely load environment variables with fallback error
 SUPABASE_URL = os.environ.get('SUPABASE_URL')
 SUPABASE_API_KEY = os.environ.get('SUPABASE_KEY')  # matches AWS key
 SUPABASE_TABLE = os.environ.get('SUPABASE_TABLE', 'products')  # fallback to 'products' if not set
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', '4'))  # concurrent records per batched event
+READ_CHUNK_SIZE = 64 * 1024
+# Written by flatten_lambda/reclassify.py: one {"match": {...}, "set": {...}}
+# per line, applied as a PATCH instead of inserting rows
+DELTA_SUFFIX = '.delta.ndjson'
 
 if not SUPABASE_URL or not SUPABASE_API_KEY:
     raise ValueError("Missing SUPABASE_URL or SUPABASE_KEY in environment variables.")
 
 s3 = boto3.client('s3')
 
+def iter_s3_records(event):
+    # S3 notifications arrive either directly or wrapped in SQS message bodies
+    for record in event.get('Records', []):
+        if record.get('eventSource') == 'aws:sqs':
+            body = json.loads(record['body'])
+            for s3_record in body.get('Records', []):
+                yield record['messageId'], s3_record
+        else:
+            yield None, record
+
+
 def lambda_handler(event, context):
+    records = list(iter_s3_records(event))
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_WORKERS, len(records)))) as pool:
+        results = list(pool.map(lambda r: process_record(*r), records))
+
+    failed = [r for r in results if r['statusCode'] != 200]
+    print(f"✅ Processed {len(results) - len(failed)}/{len(results)} files")
+
+    return {
+        'statusCode': 200 if not failed else 207,
+        'body': f'Successfully processed {len(results) - len(failed)} of {len(results)} files',
+        'results': results,
+        # Partial batch response for SQS triggers (ReportBatchItemFailures)
+        'batchItemFailures': [
+            {'itemIdentifier': mid} for mid in dict.fromkeys(r['message_id'] for r in failed) if mid
+        ],
+    }
+
+
+def process_record(message_id, record):
+    result = process_key(record['s3']['bucket']['name'], unquote_plus(record['s3']['object']['key']))
+    result['message_id'] = message_id
+    return result
+
+
+def process_key(bucket, key):
     try:
-        # Extract S3 event data
-        bucket = event['Records'][0]['s3']['bucket']['name']
-        key = event['Records'][0]['s3']['object']['key']
         print(f"✅ Lambda triggered for key: {key} in bucket: {bucket}")
 
-        # Get and parse JSON file from S3
+        # Get and parse JSON file from S3 (decompressed on the fly if .gz/.zst)
         response = s3.get_object(Bucket=bucket, Key=key)
-        content = response['Body'].read().decode('utf-8').strip()
-        data = json.loads(content, parse_float=Decimal)
+        compression = detect_compression(key, response.get('ContentEncoding'))
+        chunks = decompress_chunks(response['Body'].iter_chunks(READ_CHUNK_SIZE), compression)
 
-        print(f"📦 Retrieved {len(data)} rows from {key}")
+        if key.endswith(DELTA_SUFFIX):
+            return apply_delta(key, iter_rows(chunks))
 
         # Insert rows into Supabase
-        inserted = 0
-        for row in data:
+        retrieved = inserted = 0
+        for row in iter_rows(chunks):
+            retrieved += 1
             cleaned = prepare_row(row)
             if cleaned:
                 send_to_supabase(cleaned)
                 inserted += 1
 
+        print(f"📦 Retrieved {retrieved} rows from {key}")
         print(f"✅ Successfully inserted {inserted} rows into Supabase")
 
         return {
+            'key': key,
             'statusCode': 200,
             'body': f'Successfully processed {inserted} rows from {key}'
         }
@@ -47,6 +98,7 @@ def lambda_handler(event, context):
     except s3.exceptions.NoSuchKey:
         print(f"❌ File not found in bucket: {key}")
         return {
+            'key': key,
             'statusCode': 404,
             'body': f'File not found: {key}'
         }
@@ -54,6 +106,7 @@ def lambda_handler(event, context):
     except json.JSONDecodeError as e:
         print(f"❌ JSON decode error: {e}")
         return {
+            'key': key,
             'statusCode': 400,
             'body': f'JSON decode error in file: {key}'
         }
@@ -61,11 +114,108 @@ def lambda_handler(event, context):
     except Exception as e:
         print(f"❌ Unexpected error: {e}")
         return {
+            'key': key,
             'statusCode': 500,
             'body': f'Error processing file: {key}'
         }
 
 
+def detect_compression(key, content_encoding=None):
+    encoding = (content_encoding or '').lower()
+    if encoding in ('gzip', 'x-gzip') or key.endswith('.gz'):
+        return 'gzip'
+    if encoding == 'zstd' or key.endswith('.zst'):
+        return 'zstd'
+    return None
+
+
+def _decompressor(compression):
+    if compression == 'gzip':
+        return zlib.decompressobj(zlib.MAX_WBITS | 16)
+    if zstandard is None:
+        raise RuntimeError('zstandard is not installed; cannot read .zst objects')
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+def decompress_chunks(chunks, compression):
+    if compression is None:
+        yield from chunks
+        return
+    decompressor = _decompressor(compression)
+    for chunk in chunks:
+        # Concatenated gzip members / zstd frames each need a fresh decompressor
+        while chunk:
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+            if not decompressor.eof:
+                break
+            chunk = decompressor.unused_data
+            decompressor = _decompressor(compression)
+    data = decompressor.flush()
+    if data:
+        yield data
+
+
+def iter_lines(chunks):
+    buffered = []
+    for chunk in chunks:
+        start = 0
+        while True:
+            end = chunk.find(b'\n', start)
+            if end == -1:
+                if start < len(chunk):
+                    buffered.append(chunk[start:])
+                break
+            buffered.append(chunk[start:end])
+            yield b''.join(buffered)
+            buffered = []
+            start = end + 1
+    if buffered:
+        yield b''.join(buffered)
+
+
+def iter_rows(chunks):
+    # The flatten stage writes either a JSON array or NDJSON (OUTPUT_FORMAT).
+    # NDJSON is parsed line by line; an array has to be loaded whole.
+    chunks = iter(chunks)
+    head = b''
+    for chunk in chunks:
+        head += chunk
+        if head.strip():
+            break
+    if not head.strip() or head.lstrip().startswith(b'['):
+        content = (head + b''.join(chunks)).decode('utf-8').strip()
+        yield from json.loads(content or '[]', parse_float=Decimal)
+        return
+    for line in iter_lines(itertools.chain([head], chunks)):
+        line = line.strip()
+        if line:
+            yield json.loads(line, parse_float=Decimal)
+
+
+def to_number(value):
+    # Rows are parsed with Decimal floats, which requests can't serialise
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    return value
+
+
+def apply_delta(key, deltas):
+    applied = failed = 0
+    for delta in deltas:
+        if patch_supabase(delta['match'], {column: to_number(value) for column, value in delta['set'].items()}):
+            applied += 1
+        else:
+            failed += 1
+    print(f"✏️ Applied {applied} delta updates from {key} ({failed} failed)")
+    return {
+        'key': key,
+        'statusCode': 200 if not failed else 500,
+        'body': f'Applied {applied} of {applied + failed} delta updates from {key}'
+    }
+
+
 def prepare_row(row):
     try:
         return {
@@ -78,7 +228,7 @@ def prepare_row(row):
             'size': row.get('size'),
             'color': row.get('color'),
             'length': row.get('length'),
-            'inseam': row.get('inseam'),  # or float(row.get('inseam')) if using numeric type
+            'inseam': to_number(row.get('inseam')),  # half inches arrive as Decimal
             'available': bool(row.get('available', True)),
             'image_url': row.get('image_url'),
             'product_url': row.get('product_url'),
@@ -86,6 +236,13 @@ def prepare_row(row):
             'description': row.get('description'),
             'primary_category': row.get('primary_category'),   # ✅ new
             'subcategory': row.get('subcategory'),             # ✅ new
+            # Numeric size columns (see supabase/migrations/*_add_product_size_columns.sql)
+            'waist_in': to_number(row.get('waist_in')),
+            'inseam_in': to_number(row.get('inseam_in')),
+            'alpha_size_rank': to_number(row.get('alpha_size_rank')),
+            'shoe_size': to_number(row.get('shoe_size')),
+            'width': row.get('width'),
+            'fit_class': row.get('fit_class'),
       
         }
     except Exception as e:
@@ -109,3 +266,26 @@ def send_to_supabase(row):
             print("Insert failed:", response.status_code, response.text)
     except Exception as e:
         print("Error sending to Supabase:", e)
+
+
+def patch_supabase(match, values):
+    headers = {
+        "apikey": SUPABASE_API_KEY,
+        "Authorization": f"Bearer {SUPABASE_API_KEY}",
+        "Content-Type": "application/json",
+        "Prefer": "return=minimal"
+    }
+    try:
+        response = requests.patch(
+            f"{SUPABASE_URL}/rest/v1/{SUPABASE_TABLE}",
+            headers=headers,
+            params={column: f"eq.{value}" for column, value in match.items()},
+            json=values
+        )
+        if response.status_code not in [200, 204]:
+            print("Update failed:", response.status_code, response.text)
+            return False
+        return True
+    except Exception as e:
+        print("Error sending to Supabase:", e)
+        return False